@@ -51,304 +51,257 @@ EXAMPLES = '''
     api: "template"
     api_args: {}
     state: "absent"
-'''
-
-
-HAS_REQUESTS = False
-try:
-    from requests import Session
-except ImportError:
-    pass
-else:
-    HAS_REQUESTS = True
-
-from ansible.module_utils.basic import AnsibleModule
-
-# Mapping to retreive the primary key of and object from the object type.
-ZBX_API_UID = dict(
-    hostgroup='name',
-    template='host',
-    item='name',
-    trigger='description',
-    host='host',
-    user='alias'
-)
-
-
-class ZabbixConfig(object):
-
-    def __init__(self, module):
-
-        # api url
-        self.zbx_url = module.params["zabbix_url"]
-
-        # zbx request_id counter
-        self.zbx_request_id = 0
-        self.zbx_request = None
-
-        # to avoid error on first query
-        self.auth = None
-
-        # passing the module fail_json fct allow error handling in do_request
-        # method
-        self.fail_json = module.fail_json
-
-        self.session = Session()
-        self.session.headers.update({'Content-Type': 'application/json-rpc',
-                                     'Cache-Control': 'no-cache'})
 
-        # # inject proxy for debugging
-        # proxies = {'http': 'http://localhost:8080'}
-        # self.session.proxies = proxies
-
-        # zbx auth is done through it's api
-        # authenticate, (every request will be parsed for errors)
-        self.prepare_request('user.login',
-                             {'user': module.params["zabbix_user"],
-                              'password': module.params["zabbix_password"]}
-                             )
-
-        resp = self.do_request()
-
-        # register the auth token to use with api
-        self.auth = resp['result']
-
-    def prepare_request(self, zbx_method, zbx_params=None, extra_params=None):
-        """
-        Prepare request's json payload.
-
-        Purpose of this is to save to internal variable for ansible -vvv
-        debugging output and allow functionning of check_mode.
-        Extra params will be merged.
-        """
-        p = zbx_params.copy()
-        if extra_params is not None:
-            p.update(extra_params)
-
-        self.zbx_request = dict(jsonrpc=2.0,
-                                id=self.zbx_request_id,
-                                method=zbx_method,
-                                params=p,
-                                auth=self.auth
-                                )
-
-    def do_request(self):
-        """
-        Perform post request to zabbix api.
-
-        zbx_method: zabbix api method
-        zbx_params: content of zabbix params, not to be confused with requests
-        params.
-
-        Returns: server json response
-        """
-        self.zbx_request_id += 1
-
-        r = self.session.post(self.zbx_url, json=self.zbx_request)
-
-        resp = r.json()
-        # unsucessful login attemps returns a http 200 rc. we must examine
-        # returned json for success or failure.
-        if 'error' in resp:
-            self.fail_json(
-                msg="Zabbix API error: {}".format(
-                    resp['error']['data']))
-        else:
-            return resp
-
-    def get_objects(self, api, api_args, filter=None):
-        """
-        Retrieve one or multiple zabbix objects.
-
-        api: zabbix api to use
-        api_args: a dict or list of dict, each dict contain valid zabbix params
-        filter: a dict containing filters that will be injected literally
-            e.g: filter={"hostid": 10153} will result in:
-                    "method": "item.get",
-                    "params": [
-                        {
-                        "filter": {
-                            "hostid": 10153
-                        },
-                        ...
-
-        NOTE: Zabbix api get methods do not accept arrays. As such, it cannot
-                perform bulk query.
-        """
-
-        # zbx_params = api_args
-        zbx_params = {}
-        # zbx_params[ZBX_API_UID[api]] = api_args[ZBX_API_UID[api]]
-
-        # this is kind of hackish, but will plug a filter criteria by the name
-        # of a key found in api_args. Unique key for each api is defined in
-        # ZBX_API_UID hash.
-        zbx_params["filter"] = {ZBX_API_UID[api]: api_args[ZBX_API_UID[api]]}
-
-        # add extra filter from dict
-        if filter is not None:
-            zbx_params["filter"].update(filter)
-
-        # see also:
-        # https://www.zabbix.com/documentation/3.2/manual/api/reference_commentary#common_get_method_parameters
-
-        if "groups" in api_args:
-            zbx_params["selectGroups"] = "groupid"
-
-        if "templates" in api_args:
-            zbx_params["selectParentTemplates"] = "templateid"
-
-        if "interfaces" in api_args:
-            zbx_params["selectInterfaces"] = "extend"
-
-        if "hosts" in api_args:
-            zbx_params["selectHosts"] = "hostid"
-
-        if "hostid" in api_args:
-            zbx_params["filter"]["hostid"] = api_args["hostid"]
-
-        if api == "trigger":
-            zbx_params["expandExpression"] = True
-            zbx_params["templated"] = True
-
-        if api == "configuration.export":
-            pass
-
-        self.prepare_request("{}.get".format(api), zbx_params)
-        return self.do_request()
-
-    # def update_params(self, api_args, zbx_objects):
-    #     """
-    #     Compute required update for a list of zabbix objects.
-
-    #     api_args: list of zabbix new objects
-    #     zbx_objects: object reference retreived from zabbix. Will contain more
-    #                     objects than api_args
-
-    #     Return a modified api_args where each index only contains values to be
-    #     updated.
-    #     """
-
-    #     # if isinstance(api_args, list):
-    #     #     zbx_params = [self.json_diff(api, api_arg)
-    #     #                   for api_arg in api_args]
-    #     # elif isinstance(api_args, dict):
-    #     #     zbx_params = {}
-    #     #     zbx_params = self.json_diff(api, api_args)
-    #     pass
-
-
-def list_to_dict(l):
-    """
-    Make a dict from a list of dicts.
-
-    Input:
-        l = [     {
-        ...         "groupid": "25"
-        ...       },
-        ...       {
-        ...         "groupid": "9"
-        ...       },
-        ...       {
-        ...         "groupid": "12"
-        ...       }
-        ...     ]
-
-    Output:
-
-        {
-        '9': {'groupid': '9'},
-        '12': {'groupid': '12'},
-        '25': {'groupid': '25'}
-        }
-
-    Note: zip function in Python 3 returns an iterator instead of a list.
-            Therefore we convert iterator to list to get Consistant behavior
-            regardless of interpreter version.
-
-            We could have used something like this:
-                nd = {};
-                for elems in l:
-                    for k, v in elems.items():
-                        nd[v] = {k:v}
-
-            But it requires all values to be unique.
-            This might not be correct in all cases.
+- name: Reuse the Zabbix auth token across tasks
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    auth_cache: true
+    cache_dir: "~/.cache/zabbix_config"
+    api: template
+    api_args: { "name": "myTemplate" }
 
-    """
-    return dict(
-        list(
-            zip(map(str, range(len(l))),
-                sorted(l, key=valgetter)
-                )
-        )
-    )
+- name: Resolve template_name from a local cache of name to id
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    id_cache: true
+    id_cache_ttl: 3600
+    api: item
+    template_name: myTemplate
+    api_args: { "name": "cpu load", "key_": "system.cpu.load" }
 
+- name: Create or update many items of a template in a few calls
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: item
+    template_name: myTemplate
+    chunk_size: 500
+    api_args:
+      - { "name": "cpu load", "key_": "system.cpu.load", "type": 0,
+          "value_type": 0, "delay": 60 }
+      - { "name": "free memory", "key_": "vm.memory.size[free]", "type": 0,
+          "value_type": 3, "delay": 60 }
 
-def json_diff(d1, d2, recursive=False):
-    """
-    Recursively compare 2 json objects.
+- name: Sync all items and triggers of a template, deleting unmanaged ones
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: sync
+    template_name: myTemplate
+    prune: true
+    api_args:
+      item:
+        - { "name": "cpu load", "key_": "system.cpu.load", "type": 0,
+            "value_type": 0, "delay": 60 }
+      trigger:
+        - { "description": "cpu load is too high",
+            "expression": "{myTemplate:system.cpu.load.last()}>5",
+            "priority": 3 }
+
+- name: Sync the triggers of a large template, expanding expressions locally
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: sync
+    template_name: myTemplate
+    expand_expressions: false
+    api_args:
+      trigger: "{{ triggers }}"
 
-    d1:  reference json object
-    d2:  json object compared against d1
+- name: Create groups, templates, their items and linked hosts in one task
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: batch
+    api_args:
+      - api: hostgroup
+        api_args: [{ "name": "Linux servers" }]
+      - api: template
+        api_args:
+          - { "host": "myTemplate", "groups": [{ "name": "Templates" }] }
+      - api: item
+        template_name: myTemplate
+        api_args:
+          - { "name": "cpu load", "key_": "system.cpu.load", "type": 0,
+              "value_type": 0, "delay": 60 }
+      - api: host
+        api_args: "{{ hosts }}"   # groups and templates referenced by name
+
+- name: Link a template to every web server
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: link
+    api_args:
+      templates: ["myTemplate"]
+      host_pattern: "web*"
+      host_groups: ["Linux servers"]
 
-    Semantically equivalent to the diff command.
-    All identical keys will be popped out of d2. Pass a copy of your dict
-    if you do not want to alter your json blob.
-    Returns: True if objects are different (d2 non-empty)
-                False if objects are identical (d2 empty)
-    """
-    different = False
-    # the .keys method returns a view in python 3 (returned a list in
-    # python 2) This idiom makes it work on both interpreter
-    for k in list(d2.keys()):
+- name: Import a template only if its source changed since last import
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: configuration.import
+    template_name: myTemplate
+    import_digest: file
+    import_verify: true
+    api_args:
+      format: xml
+      source: "{{ lookup('file', 'myTemplate.xml') }}"
 
-        if k not in d1:
-            different = True
-            continue
+- name: Back up all templates to a directory, one gzipped file per template
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: configuration.export
+    kind: template
+    export_pattern: "Template *"
+    export_dest: /var/backups/zabbix/templates
+    export_compress: true
+    api_args:
+      format: xml
 
-        if not isinstance(d2[k], list) and not isinstance(d2[k], dict):
-            # cast to string for the test: zbx always return strings
-            d2[k] = str(d2[k])
-            d1[k] = str(d1[k])
-            # if str(d2[k]) != str(d1[k]):
-            if d2[k] != d1[k]:
-                different = True
-                continue
+- name: Keep the session to zabbix open across the tasks of the play
+  zabbix_config:
+    zabbix_url: "https://my.zabbix.net/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: hostgroup
+    persistent: true
+    persistent_timeout: 300
+    api_args:
+      name: myHostgroup
 
-        # recursive invocation
-        if isinstance(d1[k], dict) and isinstance(d2[k], dict):
-            if json_diff(d1[k], d2[k], True):
-                different = True
-                continue
+- name: Import through a load balancer, gzip compressing the template
+  zabbix_config:
+    zabbix_url: "https://my.zabbix.net/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: configuration.import
+    connect_timeout: 5
+    read_timeout: 600
+    retries: 5
+    retry_backoff: 1
+    compress_requests: true
+    api_args:
+      format: xml
+      source: "{{ lookup('file', 'myTemplate.xml') }}"
 
-        # recursive invocation
-        if isinstance(d1[k], list) and isinstance(d2[k], list):
-            if json_diff(list_to_dict(d1[k]), list_to_dict(d2[k]), True):
-                different = True
-                continue
+- name: Import a template from every host at once, without overloading zabbix
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: configuration.import
+    rate_limit_reads: 50
+    rate_limit_writes: 2
+    rate_limit_latency: 10
+    api_args:
+      format: xml
+      source: "{{ lookup('file', 'myTemplate.xml') }}"
 
-        if not recursive:
-            d2.pop(k)
+- name: Dump the objects managed by the play to a local snapshot
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: snapshot
+    snapshot: /tmp/zabbix-snapshot.json.gz
+    api_args:
+      - hostgroup
+      - template
+      - host
+      - item
+      - trigger
+  check_mode: false
+
+- name: Plan the items of a template against the snapshot, without api calls
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: item
+    template_name: myTemplate
+    snapshot: /tmp/zabbix-snapshot.json.gz
+    api_args: "{{ items }}"
+  check_mode: true
 
-    return different
+- name: Delete all decommissioned hosts, in a few calls
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: delete
+    chunk_size: 500
+    api_args:
+      api: host
+      pattern: "decommissioned-*"
 
+- name: Delete obsolete items of a template
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: delete
+    template_name: myTemplate
+    api_args:
+      api: item
+      names: ["old metric 1", "old metric 2"]
 
-def valgetter(x):
-    """
-    Return value from a one item dict.
+- name: Skip reading objects applied with the same args within the last day
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: item
+    template_name: myTemplate
+    ledger: true
+    ledger_ttl: 86400
+    # e.g true on a weekly run, to read all objects and repair drift
+    refresh_cache: "{{ verify | default(false) }}"
+    api_args: "{{ items }}"
+
+- name: Profile a slow task, reports are written to /tmp/zabbix-profiles
+  zabbix_config:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    api: item
+    template_name: myTemplate
+    api_args: "{{ items }}"
+  environment:
+    ZABBIX_CONFIG_PROFILE: cpu,memory
+    ZABBIX_CONFIG_PROFILE_DIR: /tmp/zabbix-profiles
+'''
 
-    input: {'groupid': '9'}
-    output: 9
+import codecs
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
 
-    Will try to cast value to int. This is required for proper sorting when
-    string is a number.
-    """
-    val = list(x.values())[0]
-    try:
-        return int(val)
-    except:
-        return val
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.zabbix_api import (
+    HAS_REQUESTS, JSON_RESULT_START, JSON_STRING_TOKEN, ZBX_API_HOSTID,
+    ZBX_API_UID, ZBX_BATCH_REFS, ZBX_DIGEST_MACRO, ZBX_IMPORT_RULES,
+    ZBX_SELECTS, ZBX_SNAPSHOT_PARAMS, ZBX_SYNC_ORDER, Metrics, RecordFactory,
+    ZabbixConfig, cache_key, chunks, get_id_string, get_object_id,
+    object_diff, report_metrics, report_profile, selector_params,
+    start_env_profiler, write_private_file, zabbix_argument_spec)
 
 
 def update_zabbix_object(module, zbx, zbx_objectid=None):
@@ -371,10 +324,19 @@ def update_zabbix_object(module, zbx, zbx_objectid=None):
 
     # quirk for zabbix hostgroup inconsistencies
     # this value is used as key in ansible meta output.
-    if api == "hostgroup":
-        id_string = "groupid"
-    else:
-        id_string = "{}id".format(api)
+    id_string = get_id_string(api)
+
+    # object unchanged since last applied, not read again
+    if zbx.ledger is not None:
+        ledger_key, digest = ledger_entry(module, api_args)
+        trusted = zbx.ledger.get(api, ledger_key, digest)
+        if trusted is not None:
+            if trusted[0] is not None:
+                meta = {api_args[ZBX_API_UID[api]]: trusted[0]}
+            module.exit_json(changed=False,
+                             meta=meta,
+                             zabbix_request=zbx.zbx_request,
+                             results=None)
 
     # Attempt to get templateid if template_name was passed. Will return
     templateid = get_object_id(zbx, 'template', module.params['template_name'])
@@ -400,41 +362,32 @@ def update_zabbix_object(module, zbx, zbx_objectid=None):
         obj_exist = True
 
     if state == "present" and not obj_exist:
-        zbx.prepare_request("{}.create".format(api), api_args, templateid)
+        extra_params = None
+        if templateid is not None and api in ZBX_API_HOSTID:
+            extra_params = dict(hostid=templateid)
+        zbx.prepare_request("{}.create".format(api), api_args, extra_params)
         changed = True
         if not module.check_mode:
             zbx_resp = zbx.do_request()
 
     elif state == "absent" and obj_exist:
-        zbx.prepare_request("{}.delete".format(api), api_args, templateid)
+        # delete methods take an array of ids
+        zbx.prepare_request("{}.delete".format(api),
+                            [zbx_objects['result'][0][id_string]])
         changed = True
         if not module.check_mode:
             zbx_resp = zbx.do_request()
 
     elif state == "present" and obj_exist:
         # check if object needs update
-        # this variable is to prevent altering ansible invocation args
-        zbx_api_args = api_args.copy()
-
-        # templates vs selectParentTemplates quirk
         current_zbx_object = zbx_objects['result'][0]
-        if 'parentTemplates' in current_zbx_object:
-            current_zbx_object['templates'] =  \
-                current_zbx_object.pop("parentTemplates")
-
-        if json_diff(current_zbx_object, zbx_api_args):
-            # import pprint; pp = pprint.PrettyPrinter(indent=2); pp.pprint(api_args)
-            # import sys; sys.exit()
+        patch = object_diff(current_zbx_object, api_args)
 
-            # Side effect of json_diff method is to pop out the uid key of a
-            # method. Let's insert it back.
-            zbx_api_args[ZBX_API_UID[api]] = api_args[ZBX_API_UID[api]]
-
-            # object id must also be inserted back
-            zbx_api_args[id_string] = current_zbx_object[id_string]
-
-            zbx.prepare_request("{}.update".format(api), zbx_api_args,
-                                templateid)
+        if patch:
+            # only changed fields are sent, along with the object id
+            zbx.prepare_request(
+                "{}.update".format(api),
+                patch.payload({id_string: current_zbx_object[id_string]}))
 
             changed = True
             if not module.check_mode:
@@ -442,8 +395,8 @@ def update_zabbix_object(module, zbx, zbx_objectid=None):
 
                 # Update only returns the string id if sucessful so we fill
                 # meta from the args
-                meta = {"name": zbx_api_args[ZBX_API_UID[api]],
-                        id_string: zbx_api_args[id_string]
+                meta = {"name": api_args[ZBX_API_UID[api]],
+                        id_string: current_zbx_object[id_string]
                         }
 
     # object was just created, we must fill meta
@@ -469,12 +422,901 @@ def update_zabbix_object(module, zbx, zbx_objectid=None):
                 zbx_resp['result'][0][id_string]
                 }
 
+    # object found or made to match args, unless planned in check mode
+    if zbx.ledger is not None and not (changed and module.check_mode):
+        object_id = None
+        if state == "present" and obj_exist:
+            object_id = zbx_objects['result'][0][id_string]
+        elif state == "present":
+            object_id = zbx_resp['result'][id_string + 's'][0]
+        zbx.ledger.put(api, [(ledger_key, object_id, digest)])
+
     module.exit_json(changed=changed,
                      meta=meta,
                      zabbix_request=zbx.zbx_request,
                      results=zbx_resp)
 
 
+def update_zabbix_objects(module, zbx):
+    """
+    Create, Update, Delete a list of zabbix objects of the same type.
+
+    Bulk counterpart of update_zabbix_object. Existing objects are fetched
+    with a single get, filtered on the array of ZBX_API_UID values. Objects
+    are then split into create, update and delete sets, sent as array params
+    in chunks of chunk_size objects.
+
+    Objects are matched by their ZBX_API_UID value and hostid if any, which
+    must therefore be unique within the scope of the query (template_name
+    or hostid), see check_unique.
+    """
+
+    # extract args from module
+    state = module.params['state']
+    api = module.params['api']
+    api_args = module.params['api_args']
+    id_string = get_id_string(api)
+    check_unique(module, api, api_args)
+
+    # objects unchanged since last applied are not read again, see Ledger
+    entries = [None] * len(api_args)
+    trusted = {}
+    if zbx.ledger is not None:
+        entries = [ledger_entry(module, api_arg) for api_arg in api_args]
+        for i, (key, digest) in enumerate(entries):
+            object_id = zbx.ledger.get(api, key, digest)
+            if object_id is not None:
+                trusted[i] = object_id[0]
+    stale = [i for i in range(len(api_args)) if i not in trusted]
+
+    plan = dict(create=[], update=[], delete=[], meta=[], changed=False)
+    if stale:
+        templateid = get_object_id(zbx, 'template',
+                                   module.params['template_name'])
+
+        filter = None
+        if templateid is not None:
+            filter = dict(hostid=templateid)
+        stale_args = [api_args[i] for i in stale]
+        zbx_objects = zbx.iter_objects(api, zbx.get_params(api, stale_args,
+                                                           filter))
+
+        plan = plan_objects(api, stale_args, zbx_objects, state, templateid)
+
+    zbx_resp = []
+    if not module.check_mode:
+        zbx_resp = apply_plan(zbx, api, plan, module.params['chunk_size'])
+
+    # meta of all objects, in order
+    meta = [None] * len(api_args)
+    for i, m in zip(stale, plan['meta']):
+        meta[i] = m
+    for i, object_id in trusted.items():
+        meta[i] = {"name": api_args[i][ZBX_API_UID[api]],
+                   id_string: object_id,
+                   "action": None}
+
+    # objects found or made to match args, unless planned in check mode
+    if zbx.ledger is not None:
+        zbx.ledger.put(api, [
+            (entries[i][0], m[id_string], entries[i][1])
+            for i, m in zip(stale, plan['meta'])
+            if m['action'] is None or not module.check_mode])
+
+    module.exit_json(changed=plan['changed'],
+                     meta=meta,
+                     zabbix_request=zbx.zbx_request,
+                     results=zbx_resp)
+
+
+def ledger_entry(module, api_arg):
+    """
+    Returns: ledger key and digest of an object to apply.
+
+    Objects are keyed by their ZBX_API_UID value, in the scope of their
+    template or host. The digest covers the args and state.
+    """
+    api = module.params['api']
+    key = json.dumps([module.params['template_name'], api_arg.get('hostid'),
+                      api_arg[ZBX_API_UID[api]]])
+    digest = hashlib.sha1(json.dumps([module.params['state'], api_arg],
+                                     sort_keys=True).encode('utf-8'))
+    return key, digest.hexdigest()
+
+
+def sync_template(module, zbx):
+    """
+    Make the children of a template match a desired state.
+
+    api_args maps a child object type to the full list of desired objects
+    of that type, e.g:
+
+        {"item": [{"name": ..., "key_": ...}, ...],
+         "trigger": [{"description": ..., "expression": ...}, ...]}
+
+    Every existing child of a type is fetched with one get for the template
+    id. Objects are diffed in memory by ZBX_API_UID key and the minimum set
+    of bulk create, update and delete calls is sent. With prune, children
+    missing from the desired list are deleted.
+
+    Deletions are sent first, in reverse dependency order, then creations
+    and updates in dependency order (items before the triggers and graphs
+    referencing them).
+    """
+    api_args = module.params['api_args']
+    chunk_size = module.params['chunk_size']
+
+    unknown = [api for api in api_args if api not in ZBX_SYNC_ORDER]
+    if unknown:
+        module.fail_json(msg="Cannot sync object types: {}. Supported: {}"
+                         .format(", ".join(unknown), ", ".join(ZBX_SYNC_ORDER)))
+
+    templateid = get_object_id(zbx, 'template', module.params['template_name'])
+    if templateid is None:
+        module.fail_json(msg="Template not found: {}"
+                         .format(module.params['template_name']))
+
+    apis = [api for api in ZBX_SYNC_ORDER if api in api_args]
+    for api in apis:
+        check_unique(module, api, api_args[api])
+
+    # one paginated get per object type, first pages sent concurrently
+    fetched = [zbx.iter_objects(api, zbx.get_params(api, api_args[api],
+                                                    hostids=[templateid]))
+               for api in apis]
+
+    plans = {}
+    for api, zbx_objects in zip(apis, fetched):
+        plans[api] = plan_objects(api, api_args[api], zbx_objects,
+                                  'present', templateid, module.params['prune'])
+
+    zbx_resp = []
+    if not module.check_mode:
+        for api in reversed(apis):
+            zbx_resp.extend(apply_plan(zbx, api, plans[api], chunk_size,
+                                       ("delete",)))
+        for api in apis:
+            zbx_resp.extend(apply_plan(zbx, api, plans[api], chunk_size,
+                                       ("create", "update")))
+
+    module.exit_json(changed=any(plan['changed'] for plan in plans.values()),
+                     meta=dict((api, plan['meta'])
+                               for api, plan in plans.items()),
+                     zabbix_request=zbx.zbx_request,
+                     results=zbx_resp)
+
+
+def link_hosts(module, zbx):
+    """
+    Link or unlink templates and host groups to a selection of hosts.
+
+    api_args holds the templates and groups to link, by name, and the host
+    selector, e.g:
+
+        {"templates": ["Template OS Linux"],
+         "groups": ["Linux servers"],
+         "hosts": ["web01", "web02"],
+         "host_pattern": "web*",
+         "host_groups": ["Web servers"]}
+
+    Hosts are selected by name, wildcard pattern on their name and/or
+    membership to host groups, all given selectors applying. The current
+    linkage of every selected host is fetched with one paginated host.get,
+    and only the delta is written with host.massadd (state present),
+    host.massremove (state absent) or host.massupdate (state present with
+    prune, linked templates and groups then being exactly the ones given),
+    in chunks of chunk_size hosts.
+    """
+    state = module.params['state']
+    prune = module.params['prune']
+    api_args = module.params['api_args']
+    chunk_size = module.params['chunk_size']
+
+    if not (api_args.get('hosts') or api_args.get('host_pattern') or
+            api_args.get('host_groups')):
+        module.fail_json(msg="link requires a host selector: hosts, "
+                         "host_pattern or host_groups")
+
+    # names to resolve, by object type
+    names = dict(template=api_args.get('templates') or [],
+                 hostgroup=(api_args.get('groups') or []) +
+                 (api_args.get('host_groups') or []))
+    apis = [api for api in sorted(names) if names[api]]
+    pending = [zbx.submit("{}.get".format(api),
+                          dict(filter={ZBX_API_UID[api]: names[api]},
+                               output=[ZBX_API_UID[api],
+                                       get_id_string(api)]))
+               for api in apis]
+
+    ids = dict((api, {}) for api in names)
+    for api, resp in zip(apis, zbx.gather(pending)):
+        for zbx_object in resp['result']:
+            ids[api][zbx_object[ZBX_API_UID[api]]] = \
+                zbx_object[get_id_string(api)]
+
+    missing = ["{} {}".format(api, name) for api in apis
+               for name in names[api] if name not in ids[api]]
+    if missing:
+        module.fail_json(msg="Not found: {}".format(", ".join(missing)))
+
+    # linkage field of host.get, its select option, element id and ids
+    links = []
+    if api_args.get('templates'):
+        links.append(('parentTemplates', 'templates', 'templateid',
+                      set(ids['template'][n] for n in api_args['templates'])))
+    if api_args.get('groups'):
+        links.append(('groups', 'groups', 'groupid',
+                      set(ids['hostgroup'][n] for n in api_args['groups'])))
+
+    zbx_params = dict(output=['hostid', 'host'])
+    for field, param, key, wanted in links:
+        zbx_params[ZBX_SELECTS[param]] = [key]
+    if api_args.get('hosts'):
+        zbx_params['filter'] = dict(host=api_args['hosts'])
+    if api_args.get('host_pattern'):
+        zbx_params['search'] = dict(host=api_args['host_pattern'])
+        zbx_params['searchWildcardsEnabled'] = True
+    if api_args.get('host_groups'):
+        zbx_params['groupids'] = [ids['hostgroup'][n]
+                                  for n in api_args['host_groups']]
+
+    # hosts needing the same change are written together
+    changes = {}
+    meta = []
+    for host in zbx.iter_objects('host', zbx_params):
+        change = []
+        for field, param, key, wanted in links:
+            current = set(e[key] for e in host.get(field, []))
+            if state == 'absent':
+                delta = current & wanted
+            elif prune:
+                delta = wanted if current != wanted else set()
+            else:
+                delta = wanted - current
+            change.append(frozenset(delta))
+
+        if not any(change):
+            meta.append({"name": host['host'], "hostid": host['hostid'],
+                         "action": None})
+            continue
+
+        changes.setdefault(tuple(change), []).append(host['hostid'])
+        meta.append({"name": host['host'], "hostid": host['hostid'],
+                     "action": "unlink" if state == 'absent' else "link"})
+
+    if state == 'absent':
+        method = 'host.massremove'
+    elif prune:
+        method = 'host.massupdate'
+    else:
+        method = 'host.massadd'
+
+    writes = []
+    for change, hostids in changes.items():
+        for chunk in chunks(hostids, chunk_size):
+            if state == 'absent':
+                zbx_params = dict(hostids=chunk)
+                for (field, param, key, wanted), delta in zip(links, change):
+                    if delta:
+                        zbx_params[key + 's'] = sorted(delta)
+            else:
+                zbx_params = dict(hosts=[dict(hostid=i) for i in chunk])
+                for (field, param, key, wanted), delta in zip(links, change):
+                    if delta:
+                        zbx_params[param] = [{key: i} for i in sorted(delta)]
+            writes.append(zbx_params)
+
+    zbx_resp = []
+    if not module.check_mode:
+        zbx_resp = zbx.gather([zbx.submit(method, zbx_params)
+                               for zbx_params in writes])
+
+    module.exit_json(changed=bool(changes),
+                     meta=meta,
+                     zabbix_request=zbx.zbx_request,
+                     results=zbx_resp)
+
+
+def batch_objects(module, zbx):
+    """
+    Create, Update, Delete a list of zabbix objects of mixed types.
+
+    api_args is a list of entries, each one with its own api, api_args,
+    state and template_name, e.g:
+
+        [{"api": "hostgroup", "api_args": [{"name": "Linux servers"}]},
+         {"api": "template",
+          "api_args": [{"host": "myTemplate",
+                        "groups": [{"name": "Templates"}]}]},
+         {"api": "item", "template_name": "myTemplate", "api_args": [...]},
+         {"api": "host", "api_args": [{"host": "myHost",
+                                       "groups": [{"name": "Linux servers"}],
+                                       "templates": [{"host": "myTemplate"}],
+                                       ...}]}]
+
+    Elements of the ZBX_BATCH_REFS fields may reference objects by their
+    ZBX_API_UID value instead of their id. Entries are ordered by the
+    objects they reference, template_name included, and items before the
+    triggers and graphs of the same template: entries only referencing
+    existing objects make the first level, entries referencing objects of
+    the first level the second one, and so on.
+
+    References to objects missing from the batch are resolved once, with one
+    get per object type. Each level is then applied as concurrent gets and
+    bulk writes, ids of the objects created feeding the next levels. Entries
+    with state absent are applied first, in reverse order.
+    """
+    entries = []
+    for entry in module.params['api_args']:
+        if not isinstance(entry, dict) or entry.get('api') not in ZBX_API_UID \
+                or 'api_args' not in entry:
+            module.fail_json(msg="Invalid batch entry, api must be one of {} "
+                             "and api_args is required: {}"
+                             .format(", ".join(sorted(ZBX_API_UID)), entry))
+
+        api_args = entry['api_args']
+        entries.append(dict(
+            api=entry['api'],
+            api_args=api_args if isinstance(api_args, list) else [api_args],
+            state=entry.get('state', module.params['state']),
+            template_name=entry.get('template_name')))
+
+    levels = batch_levels(entries)
+    if levels is None:
+        module.fail_json(msg="Batch entries reference each other in a cycle")
+
+    # name to id of the referenced objects, by object type
+    ids = resolve_batch_refs(zbx, entries)
+
+    zbx_resp = []
+    for level in reversed(levels):
+        zbx_resp.extend(apply_batch_level(
+            module, zbx, [e for e in level if e['state'] == 'absent'], ids))
+    for level in levels:
+        zbx_resp.extend(apply_batch_level(
+            module, zbx, [e for e in level if e['state'] == 'present'], ids))
+
+    module.exit_json(changed=any(e['plan']['changed'] for e in entries),
+                     meta=[dict(api=e['api'],
+                                template_name=e['template_name'],
+                                state=e['state'],
+                                level=e['level'],
+                                objects=e['plan']['meta'])
+                           for e in entries],
+                     zabbix_request=zbx.zbx_request,
+                     results=zbx_resp)
+
+
+def batch_refs(entry):
+    """
+    Return the (object type, name) of the objects referenced by a batch
+    entry, see ZBX_BATCH_REFS.
+    """
+    refs = []
+    if entry['template_name'] is not None:
+        refs.append(('template', entry['template_name']))
+
+    for api_arg in entry['api_args']:
+        for field, api in ZBX_BATCH_REFS.items():
+            for element in api_arg.get(field) or ():
+                if (isinstance(element, dict) and
+                        get_id_string(api) not in element and
+                        ZBX_API_UID[api] in element):
+                    refs.append((api, element[ZBX_API_UID[api]]))
+    return refs
+
+
+def batch_levels(entries):
+    """
+    Split batch entries in dependency levels.
+
+    The level of each entry is stored in it.
+
+    Returns: list of levels, each one a list of entries. None if entries
+    reference each other in a cycle.
+    """
+    providers = {}
+    for i, entry in enumerate(entries):
+        uid = ZBX_API_UID[entry['api']]
+        for api_arg in entry['api_args']:
+            if uid in api_arg:
+                providers[(entry['api'], api_arg[uid])] = i
+
+    deps = []
+    for i, entry in enumerate(entries):
+        entry_deps = set(providers.get(ref) for ref in batch_refs(entry))
+
+        # children of a template in sync order
+        if entry['api'] in ZBX_SYNC_ORDER:
+            order = ZBX_SYNC_ORDER.index(entry['api'])
+            entry_deps.update(
+                j for j, other in enumerate(entries)
+                if other['template_name'] == entry['template_name'] and
+                other['api'] in ZBX_SYNC_ORDER[:order])
+
+        entry_deps.discard(None)
+        entry_deps.discard(i)
+        deps.append(entry_deps)
+
+    levels = []
+    remaining = set(range(len(entries)))
+    placed = set()
+    while remaining:
+        level = sorted(i for i in remaining if deps[i] <= placed)
+        if not level:
+            return None
+
+        for i in level:
+            entries[i]['level'] = len(levels)
+        levels.append([entries[i] for i in level])
+        placed.update(level)
+        remaining.difference_update(level)
+
+    return levels
+
+
+def resolve_batch_refs(zbx, entries):
+    """
+    Resolve the ids of the objects referenced by batch entries and not
+    provided by the batch itself, with one get per object type.
+
+    Entries with state absent are applied before the batch provides any
+    object, all their references are resolved. Those provided by the batch
+    and missing from zabbix resolve to None: nothing of them is deleted.
+
+    Returns: a dict of name to id dicts, by object type.
+    """
+    provided = set()
+    for entry in entries:
+        uid = ZBX_API_UID[entry['api']]
+        provided.update((entry['api'], api_arg.get(uid))
+                        for api_arg in entry['api_args'])
+
+    names = {}
+    absent_refs = set()
+    for entry in entries:
+        for api, name in batch_refs(entry):
+            if entry['state'] == 'absent':
+                absent_refs.add((api, name))
+            elif (api, name) in provided:
+                continue
+            names.setdefault(api, set()).add(name)
+
+    apis = sorted(names)
+    pending = [zbx.submit("{}.get".format(api),
+                          dict(filter={ZBX_API_UID[api]: sorted(names[api])},
+                               output=[ZBX_API_UID[api], get_id_string(api)]))
+               for api in apis]
+
+    ids = dict((api, {}) for api in ZBX_API_UID)
+    for api, resp in zip(apis, zbx.gather(pending)):
+        for zbx_object in resp['result']:
+            ids[api][zbx_object[ZBX_API_UID[api]]] = \
+                zbx_object[get_id_string(api)]
+
+    for api, name in absent_refs & provided:
+        ids[api].setdefault(name, None)
+    return ids
+
+
+def resolve_batch_entry(module, entry, ids):
+    """
+    Replace the references by name of a batch entry with ids.
+
+    Returns: api_args of the entry, with references resolved, and the id of
+    its template. An object created in check mode, or not yet created when
+    the entry is absent, resolves to None.
+    """
+    def resolve(api, name):
+        if name not in ids[api]:
+            module.fail_json(msg="Cannot resolve {} {} referenced by a {} "
+                             "batch entry".format(api, name, entry['api']))
+        return ids[api][name]
+
+    templateid = None
+    if entry['template_name'] is not None:
+        templateid = resolve('template', entry['template_name'])
+
+    api_args = []
+    for api_arg in entry['api_args']:
+        api_arg = api_arg.copy()
+        for field, api in ZBX_BATCH_REFS.items():
+            if not isinstance(api_arg.get(field), list):
+                continue
+
+            id_string = get_id_string(api)
+            api_arg[field] = [
+                {id_string: resolve(api, element[ZBX_API_UID[api]])}
+                if (isinstance(element, dict) and
+                    id_string not in element and
+                    ZBX_API_UID[api] in element) else element
+                for element in api_arg[field]]
+        api_args.append(api_arg)
+
+    return api_args, templateid
+
+
+def apply_batch_level(module, zbx, entries, ids):
+    """
+    Plan and apply the entries of one batch level.
+
+    Entries are fetched with concurrent paginated gets, then planned and
+    written with concurrent bulk calls. The plan of each entry is stored in
+    it. ids is updated with the objects created.
+
+    Returns: list of server json responses.
+    """
+    chunk_size = module.params['chunk_size']
+
+    resolved = [resolve_batch_entry(module, entry, ids) for entry in entries]
+    for entry, (api_args, templateid) in zip(entries, resolved):
+        check_unique(module, entry['api'], api_args)
+
+    fetched = []
+    for entry, (api_args, templateid) in zip(entries, resolved):
+        if entry['template_name'] is not None and templateid is None:
+            # template to be created, check mode or absent entry
+            fetched.append([])
+            continue
+
+        filter = None
+        if templateid is not None:
+            filter = dict(hostid=templateid)
+        fetched.append(zbx.iter_objects(
+            entry['api'], zbx.get_params(entry['api'], api_args, filter)))
+
+    writes = []
+    for entry, (api_args, templateid), zbx_objects in zip(entries, resolved,
+                                                           fetched):
+        entry['plan'] = plan_objects(entry['api'], api_args, zbx_objects,
+                                     entry['state'], templateid)
+        if not module.check_mode:
+            writes.append(submit_plan(zbx, entry['api'], entry['plan'],
+                                      chunk_size))
+
+    zbx_resp = []
+    for entry, pending in zip(entries, writes):
+        zbx_resp.extend(gather_plan(zbx, entry['api'], entry['plan'],
+                                    pending))
+
+    for entry in entries:
+        if entry['state'] == 'present':
+            id_string = get_id_string(entry['api'])
+            for m in entry['plan']['meta']:
+                ids[entry['api']][m['name']] = m[id_string]
+
+    return zbx_resp
+
+
+def plan_objects(api, api_args, zbx_objects, state, templateid=None,
+                 prune=False):
+    """
+    Split a list of desired objects into create, update and delete sets.
+
+    api: zabbix api of the objects
+    api_args: list of desired objects
+    zbx_objects: existing objects, as returned by a get request or
+        iter_objects. Objects are diffed as they come and not kept, only
+        the resulting patches and ids are.
+    state: present or absent
+    templateid: id of the template owning the objects, if any
+    prune: delete existing objects missing from api_args
+
+    Returns: a dict with create, update and delete lists of params, a meta
+    list describing the action taken on every object and a changed flag.
+    """
+    uid = ZBX_API_UID[api]
+    id_string = get_id_string(api)
+
+    # keys are unique, see check_unique
+    desired = dict((object_key(api, api_arg), i)
+                   for i, api_arg in enumerate(api_args))
+
+    to_create = []
+    to_update = []
+    to_delete = []
+    # meta of desired objects, in order, then of pruned objects
+    meta = [None] * len(api_args)
+    pruned = []
+
+    for current_zbx_object in zbx_objects:
+        name = current_zbx_object[uid]
+        key = object_key(api, current_zbx_object)
+        i = desired.pop(key, None)
+        # desired objects without hostid are scoped by the query
+        if i is None and key[0] is not None:
+            i = desired.pop((None, key[1]), None)
+
+        if i is None:
+            if prune:
+                to_delete.append(current_zbx_object[id_string])
+                pruned.append({"name": name,
+                               id_string: current_zbx_object[id_string],
+                               "action": "delete"})
+            continue
+
+        if state == "absent":
+            to_delete.append(current_zbx_object[id_string])
+            action = "delete"
+        else:
+            patch = object_diff(current_zbx_object, api_args[i])
+            if patch:
+                to_update.append(
+                    patch.payload({id_string: current_zbx_object[id_string]}))
+                action = "update"
+            else:
+                action = None
+
+        meta[i] = {"name": api_args[i][uid],
+                   id_string: current_zbx_object[id_string],
+                   "action": action}
+
+    # desired objects not found
+    for i, api_arg in enumerate(api_args):
+        if meta[i] is not None:
+            continue
+
+        if state == "present":
+            # args are only copied to be completed
+            zbx_api_arg = api_arg
+            if templateid is not None and api in ZBX_API_HOSTID:
+                zbx_api_arg = dict(api_arg, hostid=templateid)
+            to_create.append(zbx_api_arg)
+            action = "create"
+        else:
+            # absent and already missing
+            action = None
+        meta[i] = {"name": api_arg[uid], id_string: None, "action": action}
+
+    return dict(create=to_create,
+                update=to_update,
+                delete=to_delete,
+                meta=meta + pruned,
+                changed=bool(to_create or to_update or to_delete))
+
+
+def object_key(api, zbx_object):
+    """
+    Key matching a desired object to an existing one.
+
+    Returns: tuple of the object hostid, None if it has none, and its
+    ZBX_API_UID value.
+    """
+    hostid = zbx_object.get('hostid')
+    return (None if hostid is None else str(hostid),
+            str(zbx_object[ZBX_API_UID[api]]))
+
+
+def check_unique(module, api, api_args):
+    """
+    Fail the module if several desired objects have the same key, see
+    object_key. Only the first one would be matched to an existing object,
+    the others created again.
+    """
+    seen = set()
+    for api_arg in api_args:
+        key = object_key(api, api_arg)
+        if key in seen:
+            if key[0] is None:
+                module.fail_json(msg="Duplicate {} {}".format(api, key[1]))
+            module.fail_json(msg="Duplicate {} {} on host {}"
+                             .format(api, key[1], key[0]))
+        seen.add(key)
+
+
+def apply_plan(zbx, api, plan, chunk_size,
+               methods=("create", "update", "delete")):
+    """
+    Send the writes of a plan computed by plan_objects.
+
+    Writes are sent as array params in chunks of chunk_size objects. The
+    create, update and delete sets are disjoint, so all chunks are sent
+    concurrently. Ids of created objects are filled in the plan meta.
+
+    methods: subset of the plan to apply.
+
+    Returns: list of server json responses.
+    """
+    return gather_plan(zbx, api, plan,
+                       submit_plan(zbx, api, plan, chunk_size, methods))
+
+
+def submit_plan(zbx, api, plan, chunk_size,
+                methods=("create", "update", "delete")):
+    """
+    Send the writes of a plan in the background, see apply_plan.
+
+    Returns: list of (method, pending request) to pass to gather_plan.
+    """
+    pending = []
+    for method in methods:
+        for chunk in chunks(plan[method], chunk_size):
+            pending.append(
+                (method, zbx.submit("{}.{}".format(api, method), chunk)))
+    return pending
+
+
+def gather_plan(zbx, api, plan, pending):
+    """
+    Wait for the writes of a plan sent with submit_plan.
+
+    Ids of created objects are filled in the plan meta.
+
+    Returns: list of server json responses.
+    """
+    id_string = get_id_string(api)
+
+    zbx_resp = zbx.gather([p for method, p in pending])
+
+    created_ids = []
+    for (method, p), resp in zip(pending, zbx_resp):
+        if method == "create":
+            created_ids.extend(resp['result'][id_string + 's'])
+
+    # zabbix returns created ids in the order objects were passed
+    created_ids = iter(created_ids)
+    if any(method == "create" for method, p in pending):
+        for m in plan['meta']:
+            if m["action"] == "create":
+                m[id_string] = next(created_ids)
+
+    return zbx_resp
+
+
+def snapshot_objects(module, zbx):
+    """
+    Dump objects of zabbix to the snapshot file, see Snapshot.
+
+    api_args is the list of object types to dump, each one a type name or a
+    dict with its api and get params restricting the objects dumped, e.g:
+
+        ["hostgroup", "template", {"api": "item", "templated": true}]
+
+    Objects of all types are fetched with concurrent paginated gets, output
+    extend and ZBX_SNAPSHOT_PARAMS, then written at once to the snapshot,
+    whose journal is reset. Gets of a restricted type are only answered from
+    the snapshot if they have the same restrictions.
+    """
+    if not module.params['snapshot']:
+        module.fail_json(msg="api snapshot requires the snapshot path")
+
+    dumps = []
+    for entry in module.params['api_args']:
+        if not isinstance(entry, dict):
+            entry = dict(api=entry)
+        api = entry.get('api')
+        if api not in ZBX_SNAPSHOT_PARAMS:
+            module.fail_json(msg="Cannot snapshot {}. Supported: {}".format(
+                api, ", ".join(sorted(ZBX_SNAPSHOT_PARAMS))))
+
+        zbx_params = dict(ZBX_SNAPSHOT_PARAMS[api], output='extend')
+        zbx_params.update((k, v) for k, v in entry.items() if k != 'api')
+        dumps.append((api, zbx_params))
+
+    # one paginated get per object type, first pages sent concurrently
+    fetched = [zbx.iter_objects(api, zbx_params) for api, zbx_params in dumps]
+
+    # objects are held as records until written, see Record
+    records = RecordFactory()
+    snapshot = dict(url=zbx.zbx_url, time=time.time(), types={})
+    for (api, zbx_params), zbx_objects in zip(dumps, fetched):
+        snapshot['types'][api] = dict(
+            params=zbx_params,
+            objects=[records.record(o) for o in zbx_objects])
+    records.clear()
+
+    path = os.path.expanduser(module.params['snapshot'])
+    if not module.check_mode:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix='.tmp-')
+        os.close(fd)
+        try:
+            with gzip.GzipFile(tmp_path, 'wb', mtime=0) as f:
+                for piece in iter_snapshot_json(snapshot):
+                    f.write(piece.encode('utf-8'))
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        if os.path.exists(path + '.journal'):
+            os.unlink(path + '.journal')
+
+    module.exit_json(changed=not module.check_mode,
+                     meta=dict((api, len(dump['objects']))
+                               for api, dump in snapshot['types'].items()),
+                     path=path,
+                     zabbix_request=zbx.zbx_request)
+
+
+def iter_snapshot_json(snapshot, batch=1000):
+    """
+    Encode a snapshot holding records to json.
+
+    Records are turned back to dicts a batch at a time, so that the dicts of
+    all objects are never held at once.
+
+    Yields: pieces of the json document.
+    """
+    header = dict((k, v) for k, v in snapshot.items() if k != 'types')
+    yield json.dumps(header, separators=(',', ':'))[:-1] + ',"types":{'
+
+    for n, (api, dump) in enumerate(snapshot['types'].items()):
+        yield '{}{}:{{"params":{},"objects":['.format(
+            ',' if n else '', json.dumps(api),
+            json.dumps(dump['params'], separators=(',', ':')))
+
+        objects = dump['objects']
+        for i in range(0, len(objects), batch):
+            yield (',' if i else '') + json.dumps(
+                [dict(r.items()) for r in objects[i:i + batch]],
+                separators=(',', ':'))[1:-1]
+        yield ']}'
+
+    yield '}}'
+
+
+def delete_objects(module, zbx):
+    """
+    Delete every object of a type matching a selector.
+
+    api_args holds the object type and the selectors, see selector_params,
+    e.g:
+
+        {"api": "host", "pattern": "decommissioned-*"}
+        {"api": "item", "names": ["cpu load", "free memory"]}
+
+    template_name limits the selection to the children of a template or
+    host, inherited ones excluded as they can only be deleted from their
+    template. At least one of names, pattern or filter is required.
+
+    Ids of the matching objects are fetched with one paginated get,
+    projected on the id and ZBX_API_UID value. They are then deleted with
+    concurrent array calls, in chunks of chunk_size ids.
+    """
+    selector = module.params['api_args']
+    api = selector.get('api')
+    if api not in ZBX_API_UID:
+        module.fail_json(msg="Cannot delete {}. Supported: {}".format(
+            api, ", ".join(sorted(ZBX_API_UID))))
+    if not (selector.get('names') or selector.get('pattern') or
+            selector.get('filter')):
+        module.fail_json(msg="delete requires a selector: names, pattern or "
+                         "filter")
+
+    uid = ZBX_API_UID[api]
+    id_string = get_id_string(api)
+
+    zbx_params = selector_params(module, zbx, api, selector,
+                                 module.params['template_name'])
+    zbx_params['output'] = [id_string, uid]
+    if api in ZBX_SYNC_ORDER:
+        zbx_params['inherited'] = False
+
+    meta = [{"name": zbx_object[uid],
+             id_string: zbx_object[id_string],
+             "action": "delete"}
+            for zbx_object in zbx.iter_objects(api, zbx_params)]
+    ids = [m[id_string] for m in meta]
+
+    zbx_resp = []
+    if not module.check_mode:
+        zbx_resp = zbx.gather([zbx.submit("{}.delete".format(api), chunk)
+                               for chunk in chunks(ids, module.params[
+                                   'chunk_size'])])
+        if zbx.ledger is not None:
+            zbx.ledger.drop(api, ids)
+
+    module.exit_json(changed=bool(ids),
+                     count=len(ids),
+                     meta=meta,
+                     zabbix_request=zbx.zbx_request,
+                     results=zbx_resp)
+
+
 def zabbix_config(module, zbx):
     """
     Import and export Zabbix configuration data.
@@ -507,6 +1349,10 @@ def zabbix_config(module, zbx):
     changed = False
     api = module.params['api']
     zbx_resp = None
+    digest = None
+
+    if api == 'configuration.export' and module.params['export_dest']:
+        return export_to_dir(module, zbx)
 
     if api == 'configuration.export':
 
@@ -525,72 +1371,29 @@ def zabbix_config(module, zbx):
                             )
 
     else:
-        # Import rules. Picked those as enabled in the UI template import
-        # wizard.
+        # check if the configuration changed since last import
+        if module.params['import_digest'] != 'off':
+            if (module.params['import_verify'] and
+                    module.params['import_digest'] != 'file'):
+                module.fail_json(msg="import_verify requires "
+                                     "import_digest=file")
+
+            kind, name = get_import_target(module)
+            digest = config_digest(module.params['api_args'])
+            state = read_import_state(module, zbx, kind, name)
+
+            if (state.get('source') == digest and
+                    (not module.params['import_verify'] or
+                     state.get('export') == export_digest(module, zbx, kind,
+                                                          name))):
+                module.exit_json(changed=False,
+                                 digest=digest,
+                                 zabbix_request=zbx.zbx_request,
+                                 results=None)
+
         zbx.prepare_request("configuration.import",
                             module.params['api_args'],
-                            {"rules": dict(
-                                applications=dict(
-                                    createMissing='true',
-                                    updateExisting='true',
-                                    deleteMissing='true'
-                                ),
-                                items=dict(
-                                    createMissing='true',
-                                    updateExisting='true',
-                                    deleteMissing='true'
-                                ),
-                                triggers=dict(
-                                    createMissing='true',
-                                    updateExisting='true',
-                                    deleteMissing='true'
-                                ),
-                                templates=dict(
-                                    createMissing='true',
-                                    updateExisting='true'
-                                ),
-                                graphs=dict(
-                                    createMissing='true',
-                                    updateExisting='true',
-                                    deleteMissing='true'
-                                ),
-                                groups=dict(
-                                    createMissing='true'
-                                ),
-                                hosts=dict(
-                                    createMissing='true',
-                                    updateExisting='true'
-                                ),
-                                httptests=dict(
-                                    createMissing='true',
-                                    updateExisting='true',
-                                    deleteMissing='true'
-                                ),
-                                templateLinkage=dict(
-                                    createMissing='true'
-                                ),
-                                templateScreens=dict(
-                                    createMissing='true',
-                                    updateExisting='true',
-                                    deleteMissing='true'
-                                ),
-                                images=dict(
-                                    createMissing='true',
-                                    updateExisting='true'
-                                ),
-                                maps=dict(
-                                    createMissing='true',
-                                    updateExisting='true'
-                                ),
-                                screens=dict(
-                                    createMissing='true',
-                                    updateExisting='true'
-                                ),
-                                valueMaps=dict(
-                                    createMissing='true',
-                                    updateExisting='true'
-                                )
-                            )}
+                            {"rules": ZBX_IMPORT_RULES}
                             )
 
     if not module.check_mode:
@@ -600,62 +1403,431 @@ def zabbix_config(module, zbx):
         if api == 'configuration.import':
             changed = zbx_resp['result']
 
+            if digest is not None:
+                zbx_request = zbx.zbx_request
+                state = dict(source=digest)
+                if module.params['import_verify']:
+                    state['export'] = export_digest(module, zbx, kind, name)
+                write_import_state(module, zbx, kind, name, state)
+                zbx.zbx_request = zbx_request
+
     module.exit_json(changed=changed,
+                     digest=digest,
                      zabbix_request=zbx.zbx_request,
                      results=zbx_resp)
 
 
-def get_object_id(zbx, object_type, object_name=None):
+def get_import_target(module):
+    """
+    Return the kind and name of the object a configuration is imported to.
+
+    template_name module arg prevails over zbx_name and kind.
+    """
+    if module.params['template_name'] is not None:
+        return 'template', module.params['template_name']
+
+    if module.params['zbx_name'] is None or module.params['kind'] is None:
+        module.fail_json(msg="import_digest requires template_name, or "
+                             "zbx_name and kind")
+
+    return module.params['kind'], module.params['zbx_name']
+
+
+def normalize_config(source, fmt):
     """
-    Get a zabbix object id.
+    Normalize a configuration document before hashing it.
 
-    zbx: zbx object to interact with zabbix api
-    object_type: kind of the object (item, trigger, template,...)
-    object_name: object name to get the id of.
+    Export date and formatting are dropped, so that the same configuration
+    always gives the same digest.
+    """
+    if fmt == 'json':
+        try:
+            doc = json.loads(source)
+        except ValueError:
+            return source
+        doc.get('zabbix_export', {}).pop('date', None)
+        return json.dumps(doc, sort_keys=True, separators=(',', ':'))
+
+    source = re.sub(r'<date>[^<]*</date>', '', source)
+    return re.sub(r'>\s+<', '><', source.strip())
 
 
-    Returns: Object id or None if object_name is None.
+def config_digest(api_args):
     """
-    if object_name is None:
+    Hash a configuration.import payload.
+
+    Import rules are part of the digest, as changing them changes the
+    result of an import.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(ZBX_IMPORT_RULES, sort_keys=True).encode('utf-8'))
+    h.update(normalize_config(api_args['source'],
+                              api_args.get('format')).encode('utf-8'))
+    return h.hexdigest()
+
+
+def export_digest(module, zbx, kind, name):
+    """
+    Hash a fresh configuration.export of the import target.
+
+    Returns: digest or None if the target does not exist.
+    """
+    object_id = get_object_id(zbx, kind, name)
+    if object_id is None:
         return None
+
+    fmt = module.params['api_args'].get('format', 'xml')
+    zbx.prepare_request("configuration.export",
+                        dict(format=fmt,
+                             options={"{}s".format(kind): [object_id]}))
+    resp = zbx.do_request()
+    return hashlib.sha256(
+        normalize_config(resp['result'], fmt).encode('utf-8')).hexdigest()
+
+
+def read_import_state(module, zbx, kind, name):
+    """
+    Read the digests recorded by the last import of a target.
+
+    Digests are stored in a local state file (import_digest=file), or in
+    the ZBX_DIGEST_MACRO user macro of the target (import_digest=macro).
+
+    Returns: dict with source digest, and export digest if verified.
+    """
+    if module.params['import_digest'] == 'file':
+        try:
+            with open(import_state_file(module, kind, name)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    macro = get_digest_macro(zbx, kind, name)
+    if macro is None:
+        return {}
+    return dict(source=macro['value'])
+
+
+def write_import_state(module, zbx, kind, name, state):
+    """
+    Record the digests of an import. See read_import_state.
+    """
+    if module.params['import_digest'] == 'file':
+        write_private_file(import_state_file(module, kind, name),
+                           json.dumps(state))
+        return
+
+    macro = get_digest_macro(zbx, kind, name)
+    if macro is None:
+        zbx.prepare_request("usermacro.create",
+                            dict(hostid=get_object_id(zbx, kind, name),
+                                 macro=ZBX_DIGEST_MACRO,
+                                 value=state['source']))
     else:
-        if object_type == 'group':
-            res = zbx.get_objects('hostgroup',
-                                  {ZBX_API_UID['hostgroup']: object_name})
-        else:
-            res = zbx.get_objects(object_type,
-                                  {ZBX_API_UID[object_type]: object_name})
+        zbx.prepare_request("usermacro.update",
+                            dict(hostmacroid=macro['hostmacroid'],
+                                 value=state['source']))
+    zbx.do_request()
 
-        if len(res['result']) > 0:
-            if object_type == 'group':
-                return res['result'][0]['groupid']
-            else:
-                return res['result'][0]["{}id".format(object_type)]
-        else:
-            return None
+
+def import_state_file(module, kind, name):
+    return os.path.join(
+        os.path.expanduser(module.params['cache_dir']),
+        "import-{}.json".format(
+            cache_key(module.params['zabbix_url'], kind, name)))
+
+
+def get_digest_macro(zbx, kind, name):
+    """
+    Returns: the ZBX_DIGEST_MACRO user macro of a host or template, None if
+    either does not exist.
+    """
+    object_id = get_object_id(zbx, kind, name)
+    if object_id is None:
+        return None
+
+    zbx.prepare_request("usermacro.get",
+                        dict(hostids=[object_id],
+                             output=['hostmacroid', 'value'],
+                             filter=dict(macro=ZBX_DIGEST_MACRO)))
+    res = zbx.do_request()['result']
+    if len(res) > 0:
+        return res[0]
+    return None
+
+
+def export_to_dir(module, zbx):
+    """
+    Export many templates or hosts to files of a directory.
+
+    Objects of type kind (template by default) are selected by a list of
+    names (export_names) or a wildcard pattern (export_pattern), then
+    exported concurrently, one configuration.export per object. Responses
+    are streamed to <export_dest>/<name>.<format>[.gz] without holding the
+    document in memory.
+
+    A file is only replaced if the digest of its content changed, export
+    date excluded. Module result only holds paths and digests.
+    """
+    kind = module.params['kind'] or 'template'
+    dest = module.params['export_dest']
+    fmt = module.params['api_args'].get('format', 'xml')
+    uid = ZBX_API_UID[kind]
+    id_string = get_id_string(kind)
+
+    zbx_params = dict(output=[id_string, uid])
+    if module.params['export_names']:
+        zbx_params['filter'] = {uid: module.params['export_names']}
+    elif module.params['export_pattern']:
+        zbx_params['search'] = {uid: module.params['export_pattern']}
+        zbx_params['searchWildcardsEnabled'] = True
+    else:
+        module.fail_json(msg="export_dest requires export_names or "
+                             "export_pattern")
+
+    zbx.prepare_request("{}.get".format(kind), zbx_params)
+    zbx_objects = zbx.do_request()['result']
+
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+
+    extension = fmt
+    if module.params['export_compress']:
+        extension += '.gz'
+
+    pending = []
+    for zbx_object in zbx_objects:
+        path = os.path.join(dest, "{}.{}".format(
+            re.sub(r'[^\w.-]', '_', zbx_object[uid]), extension))
+        zbx_request = zbx.build_request(
+            "configuration.export",
+            dict(format=fmt,
+                 options={"{}s".format(kind): [zbx_object[id_string]]}))
+        pending.append(zbx.run_async(
+            export_to_file,
+            (zbx, zbx_request, path, module.params['export_compress'],
+             module.check_mode)))
+
+    exports = []
+    for zbx_object, resp in zip(zbx_objects, zbx.gather(pending)):
+        export = dict(name=zbx_object[uid], **resp['result'])
+        export[id_string] = zbx_object[id_string]
+        exports.append(export)
+
+    module.exit_json(changed=any(e['changed'] for e in exports),
+                     exports=exports,
+                     zabbix_request=zbx.zbx_request)
+
+
+def export_to_file(zbx, zbx_request, path, compress=False, check_mode=False):
+    """
+    Stream a configuration.export response to a file.
+
+    The exported document is decoded from the json-rpc response as it is
+    received and written to a temporary file, which replaces path if its
+    digest differs from the one of the existing file. The request is sent
+    through ZabbixConfig.post, which sends it again as needed, the file
+    being written again.
+
+    Runs on the thread pool, see ZabbixConfig.run_async.
+
+    Returns: a server json response shaped dict. Result holds path, digest
+    and changed.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    os.close(fd)
+
+    def receive(chunks):
+        hasher = ConfigHasher()
+        with open_export(tmp_path, 'w', compress) as f:
+            pieces = iter_json_result(chunks)
+            error = next(pieces)
+            if error is not None:
+                return error
+            for piece in pieces:
+                hasher.update(piece)
+                f.write(piece.encode('utf-8'))
+        return dict(result=hasher.hexdigest())
+
+    try:
+        resp = zbx.post(zbx_request, receive=receive)
+        if 'error' in resp:
+            return resp
+
+        digest = resp['result']
+        changed = digest != file_digest(path, compress)
+        if changed and not check_mode:
+            os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    return dict(result=dict(path=path, digest=digest, changed=changed))
+
+
+def open_export(path, mode, compress=False):
+    """
+    Open an export file in binary mode, through gzip if compress.
+
+    gzip header timestamp is zeroed so that identical exports give identical
+    files.
+    """
+    if compress:
+        return gzip.GzipFile(path, mode + 'b', mtime=0)
+    return open(path, mode + 'b')
+
+
+class ConfigHasher(object):
+    """
+    Incremental digest of a configuration document, export date excluded.
+
+    The export date sits at the top of the document. The first head_size
+    characters are kept until the date can be stripped, see
+    normalize_config.
+    """
+
+    head_size = 4096
+
+    def __init__(self):
+        self.sha = hashlib.sha256()
+        self.head = ''
+
+    def update(self, text):
+        if self.head is None:
+            self.sha.update(text.encode('utf-8'))
+            return
+
+        self.head += text
+        if len(self.head) >= self.head_size:
+            self.flush()
+
+    def flush(self):
+        if self.head is not None:
+            self.sha.update(strip_export_date(self.head).encode('utf-8'))
+            self.head = None
+
+    def hexdigest(self):
+        self.flush()
+        return self.sha.hexdigest()
+
+
+def strip_export_date(text):
+    """
+    Remove the export date from the head of an xml or json export.
+    """
+    text = re.sub(r'<date>[^<]*</date>', '', text, count=1)
+    return re.sub(r'"date"\s*:\s*"[^"]*",?', '', text, count=1)
+
+
+def file_digest(path, compress=False):
+    """
+    Digest of an existing export file, see ConfigHasher.
+
+    Returns: digest or None if file does not exist or cannot be read.
+    """
+    hasher = ConfigHasher()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open_export(path, 'r', compress) as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                hasher.update(decoder.decode(chunk))
+    except (IOError, OSError, EOFError):
+        return None
+    hasher.update(decoder.decode(b'', final=True))
+    return hasher.hexdigest()
+
+
+def iter_json_result(chunks):
+    """
+    Decode the string result of a json-rpc response as it is received.
+
+    chunks: iterable of response text chunks
+
+    First yielded value is None if the result is a string, or the whole
+    decoded response otherwise (e.g an api error). Decoded pieces of the
+    result string follow.
+    """
+    chunks = iter(chunks)
+    text = ''
+    for chunk in chunks:
+        text += chunk
+        m = JSON_RESULT_START.search(text)
+        if m is not None:
+            break
+        if '"error"' in text:
+            # not a string result, decode it at once
+            yield json.loads(text + ''.join(chunks))
+            return
+    else:
+        yield json.loads(text)
+        return
+
+    yield None
+
+    text = text[m.end():]
+    while True:
+        pos = 0
+        while True:
+            token = JSON_STRING_TOKEN.match(text, pos)
+            if token is None:
+                break
+            pos = token.end()
+
+        end = pos < len(text) and text[pos] == '"'
+
+        # keep a high surrogate escape with its low surrogate
+        if not end and re.search(r'\\u[dD][89abAB][0-9a-fA-F]{2}$',
+                                 text[:pos]):
+            pos -= 6
+
+        if pos > 0:
+            yield json.loads('"' + text[:pos] + '"')
+
+        if end:
+            return
+
+        text = text[pos:]
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("Truncated configuration.export response")
+        text += chunk
 
 
 def main():
+    argument_spec = zabbix_argument_spec()
+    argument_spec.update(
+        api=dict(required=True, type="str"),
+        api_args=dict(required=True, type="raw"),
+        template_name=dict(required=False, type="str"),
+        zbx_name=dict(required=False, type="str"),
+        kind=dict(required=False, type="str"),
+        state=dict(default="present",
+                   choices=["present", "absent"], type="str"),
+        chunk_size=dict(default=500, type="int"),
+        prune=dict(default=False, type="bool"),
+        import_digest=dict(default="off",
+                           choices=["off", "file", "macro"], type="str"),
+        import_verify=dict(default=False, type="bool"),
+        export_dest=dict(required=False, type="path"),
+        export_names=dict(required=False, type="list"),
+        export_pattern=dict(required=False, type="str"),
+        export_compress=dict(default=False, type="bool"),
+        ledger=dict(default=False, type="bool"),
+        ledger_ttl=dict(default=86400, type="int")
+    )
     module = AnsibleModule(
-        argument_spec=dict(
-            zabbix_url=dict(required=True, type="str"),
-            zabbix_user=dict(required=True, type="str"),
-            zabbix_password=dict(required=True, type="str", no_log=True),
-            api=dict(required=True, type="str"),
-            api_args=dict(required=True, type="raw"),
-            template_name=dict(required=False, type="str"),
-            zbx_name=dict(required=False, type="str"),
-            kind=dict(required=False, type="str"),
-            state=dict(default="present",
-                       choices=["present", "absent"], type="str")
-        ),
+        argument_spec=argument_spec,
         supports_check_mode=True
     )
+    report_profile(module)
+    metrics = Metrics()
+    report_metrics(module, metrics, module.params['api'])
+
     if (HAS_REQUESTS is False):
         module.fail_json(msg="'requests' package not found... \
                          you can try install using pip: pip install requests")
 
-    zbx = ZabbixConfig(module)
+    zbx = ZabbixConfig(module, metrics)
 
     if module.params['api'].startswith('configuration'):
         # Use zabbix configurations loading mechanism. This is handy to work
@@ -663,8 +1835,22 @@ def main():
         zabbix_config(module, zbx)
     else:
         # Interact with zbx using other api methods.
-        update_zabbix_object(module, zbx)
+        if module.params['api'] == 'sync':
+            sync_template(module, zbx)
+        elif module.params['api'] == 'batch':
+            batch_objects(module, zbx)
+        elif module.params['api'] == 'link':
+            link_hosts(module, zbx)
+        elif module.params['api'] == 'snapshot':
+            snapshot_objects(module, zbx)
+        elif module.params['api'] == 'delete':
+            delete_objects(module, zbx)
+        elif isinstance(module.params['api_args'], list):
+            update_zabbix_objects(module, zbx)
+        else:
+            update_zabbix_object(module, zbx)
 
 
 if __name__ == '__main__':
+    start_env_profiler()
     main()
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+# Copyright (c) 2017 [Guavus]
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+
+ANSIBLE_METADATA = {'metadata_version': '1.0',
+                    'status': ['preview'],
+                    'supported_by': 'community'}
+
+DOCUMENTATION = '''
+---
+module: zabbix_facts
+short_description: Gather zabbix object ids and fields as facts
+description:
+ This module reads objects through the Zabbix API and sets the zabbix_facts
+ fact. It takes the connection, cache and snapshot options of zabbix_config.
+author:
+  - "Sebastien Nobert (sebastien.nobert@guavus.com)"
+  - "Felix Archambault (felix.archambault@guavus.com)"
+requirements:
+    - requests
+'''
+
+EXAMPLES = '''
+- name: Gather the ids of templates and host groups once for the play
+  zabbix_facts:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    facts_ttl: 600
+    queries:
+      - hostgroup
+      - { api: template, pattern: "Template *" }
+      - { api: host, names: ["web01", "web02"], fields: ["status", "groups"] }
+
+- name: Use a gathered id
+  debug:
+    msg: "{{ zabbix_facts.template.ids['Template OS Linux'] }}"
+
+- name: Gather facts from a snapshot, without api calls
+  zabbix_facts:
+    zabbix_url: "http://my.zabbix.net:8080/"
+    zabbix_user: Admin
+    zabbix_password: zabbix
+    snapshot: /tmp/zabbix-snapshot.json.gz
+    queries: [template]
+'''
+
+import json
+import os
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.zabbix_api import (
+    HAS_REQUESTS, ZBX_API_UID, ZBX_IMPORT_TYPES, Metrics, ZabbixConfig,
+    cache_key, get_id_string, get_projection, report_metrics, report_profile,
+    selector_params, start_env_profiler, write_private_file,
+    zabbix_argument_spec)
+
+
+def gather_facts(module, zbx):
+    """
+    Gather ids and fields of zabbix objects, as facts for the next tasks.
+
+    queries option: list of object types, or of dicts with an api and
+    optionally:
+
+        names, pattern, filter: selectors, see selector_params
+        template_name: only select the children of a template or host
+        fields: fields to fetch on top of the id and ZBX_API_UID value,
+            list fields (groups, templates,...) fetched with their key
+
+    e.g: ["hostgroup", {"api": "template", "pattern": "Template OS *"},
+          {"api": "host", "names": ["web01"], "fields": ["status", "groups"]}]
+
+    All objects of a type are selected if no selector is given.
+    Queries are fetched with concurrent paginated gets. Facts are cached in
+    cache_dir for facts_ttl seconds, keyed by url and queries, and served
+    from the cache without any api call. The id cache, if enabled, is filled
+    with the ids gathered.
+
+    Sets the zabbix_facts fact: per object type, "ids" maps names to ids and
+    "objects" maps ids to objects.
+    """
+    queries = []
+    for query in module.params['queries']:
+        if not isinstance(query, dict):
+            query = dict(api=query)
+        if query.get('api') not in ZBX_API_UID:
+            module.fail_json(msg="Cannot gather facts of {}. Supported: {}"
+                             .format(query.get('api'),
+                                     ", ".join(sorted(ZBX_API_UID))))
+        queries.append(query)
+
+    cache_file = os.path.join(
+        os.path.expanduser(module.params['cache_dir']),
+        "facts-{}.json".format(cache_key(
+            zbx.zbx_url, json.dumps(queries, sort_keys=True))))
+
+    facts = None
+    if not module.params['refresh_cache']:
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if time.time() - cached['time'] <= module.params['facts_ttl']:
+                facts = cached['facts']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    if facts is None:
+        fetched = []
+        for query in queries:
+            api = query['api']
+            zbx_params = get_projection(
+                api, dict((field, []) for field in query.get('fields') or ()))
+            zbx_params.update(selector_params(module, zbx, api, query,
+                                              query.get('template_name')))
+
+            # first pages sent concurrently
+            fetched.append(zbx.iter_objects(api, zbx_params))
+
+        facts = {}
+        for query, zbx_objects in zip(queries, fetched):
+            api = query['api']
+            uid = ZBX_API_UID[api]
+            id_string = get_id_string(api)
+
+            api_facts = facts.setdefault(api, dict(ids={}, objects={}))
+            for zbx_object in zbx_objects:
+                api_facts['ids'][zbx_object[uid]] = zbx_object[id_string]
+                # records answered from a snapshot are not serializable
+                api_facts['objects'][zbx_object[id_string]] = \
+                    dict(zbx_object.items())
+
+        write_private_file(cache_file, json.dumps(dict(url=zbx.zbx_url,
+                                                       time=time.time(),
+                                                       facts=facts)))
+
+        if zbx.id_cache is not None:
+            now = time.time()
+
+            def change(entries):
+                for api in ZBX_IMPORT_TYPES:
+                    for name, object_id in facts.get(api, {}).get(
+                            'ids', {}).items():
+                        entries.setdefault(api, {})[name] = [object_id, now,
+                                                             now]
+
+            zbx.id_cache.update(change)
+
+    module.exit_json(changed=False,
+                     ansible_facts=dict(zabbix_facts=facts),
+                     zabbix_request=zbx.zbx_request)
+
+
+def main():
+    argument_spec = zabbix_argument_spec()
+    argument_spec.update(
+        queries=dict(required=True, type="list"),
+        facts_ttl=dict(default=300, type="int")
+    )
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+    report_profile(module)
+    metrics = Metrics()
+    report_metrics(module, metrics, 'facts')
+
+    if (HAS_REQUESTS is False):
+        module.fail_json(msg="'requests' package not found... \
+                         you can try install using pip: pip install requests")
+
+    # cached facts are served without logging in
+    zbx = ZabbixConfig(module, metrics, defer_login=True)
+    gather_facts(module, zbx)
+
+
+if __name__ == '__main__':
+    start_env_profiler()
+    main()
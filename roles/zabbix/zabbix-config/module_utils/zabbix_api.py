@@ -0,0 +1,2890 @@
+# Copyright (c) 2017 [Guavus]
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+
+"""
+Zabbix api client shared by the zabbix_config and zabbix_facts modules.
+
+ZabbixConfig sends the requests, with its transport, caches, snapshot and
+broker. Helpers resolve ids and compare objects with their desired state.
+"""
+
+
+import codecs
+import fcntl
+import fnmatch
+import gzip
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import select
+import socket
+import tempfile
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import cProfile
+import pstats
+
+HAS_TRACEMALLOC = False
+try:
+    import tracemalloc
+except ImportError:
+    pass
+else:
+    HAS_TRACEMALLOC = True
+
+# Accelerated json backends, used with fast_json.
+HAS_ORJSON = False
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    HAS_ORJSON = True
+
+HAS_UJSON = False
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    HAS_UJSON = True
+
+HAS_REQUESTS = False
+try:
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+    from requests.exceptions import ConnectionError as RequestsConnectionError
+    from requests.exceptions import RequestException, Timeout
+except ImportError:
+    pass
+else:
+    HAS_REQUESTS = True
+
+# Mapping to retreive the primary key of and object from the object type.
+ZBX_API_UID = dict(
+    hostgroup='name',
+    template='host',
+    item='name',
+    trigger='description',
+    host='host',
+    user='alias',
+    graph='name',
+    discoveryrule='name'
+)
+
+# Object types whose id field is not "<type>id".
+ZBX_API_ID = dict(
+    hostgroup='groupid',
+    discoveryrule='itemid'
+)
+
+# Fields returned by get requests under another name than the one used by
+# create and update, e.g templates are returned with selectParentTemplates.
+ZBX_FIELD_ALIASES = dict(
+    templates='parentTemplates'
+)
+
+# Natural key of the elements of list fields, used to match desired elements
+# with existing ones.
+ZBX_LIST_KEYS = dict(
+    groups=('groupid',),
+    templates=('templateid',),
+    hosts=('hostid',),
+    interfaces=('interfaceid',),
+    tags=('tag', 'value'),
+    macros=('macro',),
+    gitems=('itemid',),
+    applications=('applicationid',)
+)
+
+# get option fetching each list field, see get_projection
+ZBX_SELECTS = dict(
+    groups='selectGroups',
+    templates='selectParentTemplates',
+    hosts='selectHosts',
+    interfaces='selectInterfaces',
+    tags='selectTags',
+    macros='selectMacros',
+    gitems='selectGraphItems',
+    applications='selectApplications'
+)
+
+# Params only accepted by create and update methods, never fetched.
+ZBX_WRITE_ONLY = ('templates_clear', 'passwd', 'usrgrps', 'user_medias')
+
+# Object types created with the hostid of their owning host or template.
+ZBX_API_HOSTID = ('item', 'discoveryrule')
+
+# Template children handled by sync, in dependency order.
+ZBX_SYNC_ORDER = ('discoveryrule', 'item', 'trigger', 'graph')
+
+# Fields of batch entries which may reference objects by name, mapped to the
+# type of the referenced objects. e.g: "groups": [{"name": "Linux servers"}]
+ZBX_BATCH_REFS = dict(
+    groups='hostgroup',
+    templates='template',
+    templates_clear='template'
+)
+
+# Options of trigger gets selecting what raw expressions reference, to
+# expand them locally, see expand_trigger.
+ZBX_TRIGGER_SELECTS = dict(
+    selectFunctions=['functionid', 'itemid', 'function', 'parameter'],
+    selectItems=['itemid', 'key_', 'hostid'],
+    selectHosts=['hostid', 'host']
+)
+
+# Trigger fields holding an expression.
+ZBX_TRIGGER_EXPRESSIONS = ('expression', 'recovery_expression')
+
+# Type of the strings decoded from json.
+TEXT_TYPE = type(u'')
+
+# Function reference of a raw trigger expression, e.g {13083}.
+TRIGGER_FUNCTION_REF = re.compile(r'{(\d+)}')
+
+# Params of the get requests dumping each object type to a snapshot, on top
+# of output=extend. Lists are selected in full. Triggers and graphs are
+# selected with their hosts, which filter them by hostid.
+ZBX_SNAPSHOT_PARAMS = dict(
+    hostgroup=dict(),
+    template=dict(selectGroups='extend', selectParentTemplates='extend',
+                  selectMacros='extend'),
+    host=dict(selectGroups='extend', selectParentTemplates='extend',
+              selectMacros='extend', selectInterfaces='extend'),
+    item=dict(selectApplications='extend'),
+    trigger=dict(selectHosts='extend', expandExpression=True,
+                 templated=True),
+    graph=dict(selectHosts='extend', selectGraphItems='extend'),
+    user=dict(),
+    discoveryrule=dict()
+)
+
+# Get params a snapshot evaluates itself, see Snapshot.get. Other params
+# must have the value the objects were dumped with.
+SNAPSHOT_GET_PARAMS = ('output', 'limit', 'filter', 'search',
+                       'searchWildcardsEnabled', 'hostids', 'groupids',
+                       'inherited')
+
+# Object types resolved by get_object_id whose cached ids are invalidated by
+# configuration.import.
+ZBX_IMPORT_TYPES = ('hostgroup', 'template', 'host')
+
+# Import rules. Picked those as enabled in the UI template import wizard.
+ZBX_IMPORT_RULES = dict(
+    applications=dict(
+        createMissing='true',
+        updateExisting='true',
+        deleteMissing='true'
+    ),
+    items=dict(
+        createMissing='true',
+        updateExisting='true',
+        deleteMissing='true'
+    ),
+    triggers=dict(
+        createMissing='true',
+        updateExisting='true',
+        deleteMissing='true'
+    ),
+    templates=dict(
+        createMissing='true',
+        updateExisting='true'
+    ),
+    graphs=dict(
+        createMissing='true',
+        updateExisting='true',
+        deleteMissing='true'
+    ),
+    groups=dict(
+        createMissing='true'
+    ),
+    hosts=dict(
+        createMissing='true',
+        updateExisting='true'
+    ),
+    httptests=dict(
+        createMissing='true',
+        updateExisting='true',
+        deleteMissing='true'
+    ),
+    templateLinkage=dict(
+        createMissing='true'
+    ),
+    templateScreens=dict(
+        createMissing='true',
+        updateExisting='true',
+        deleteMissing='true'
+    ),
+    images=dict(
+        createMissing='true',
+        updateExisting='true'
+    ),
+    maps=dict(
+        createMissing='true',
+        updateExisting='true'
+    ),
+    screens=dict(
+        createMissing='true',
+        updateExisting='true'
+    ),
+    valueMaps=dict(
+        createMissing='true',
+        updateExisting='true'
+    )
+)
+
+# User macro holding the digest of the last configuration imported to a
+# template or host, with import_digest=macro.
+ZBX_DIGEST_MACRO = '{$ZABBIX_CONFIG_DIGEST}'
+
+# Clock used to time requests.
+timer = getattr(time, 'perf_counter', time.time)
+
+# Error data returned by the api when the auth token is no longer valid.
+ZBX_SESSION_TERMINATED = 'Session terminated'
+
+# Error code returned by the api for a request it could not parse, e.g a
+# compressed request the web server did not decompress.
+ZBX_PARSE_ERROR = -32700
+
+# Methods sent without auth token.
+ZBX_AUTH_METHODS = ('user.login', 'user.checkAuthentication',
+                    'apiinfo.version')
+
+# Methods safe to send again if their response was lost, get methods aside.
+ZBX_IDEMPOTENT_METHODS = ('user.login', 'user.checkAuthentication',
+                          'apiinfo.version', 'configuration.export')
+
+# HTTP statuses of transient failures, e.g from a load balancer, retried for
+# idempotent methods.
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Max seconds to wait before retrying a request.
+RETRY_MAX_DELAY = 30
+
+# Request bodies from this size are compressed, with compress_requests.
+COMPRESS_MIN_SIZE = 65536
+
+# Adaptive rate limiting, see RateLimiter: rate is halved on failures or
+# slow responses, at most once per interval seconds, down to a fraction of
+# the configured limit, and increased back by a fraction of the limit per
+# successful response.
+RATE_LIMIT_BACKOFF_INTERVAL = 1
+RATE_LIMIT_MIN_FRACTION = 0.05
+RATE_LIMIT_INCREASE = 0.02
+
+# Tokens of a json string content: unescaped characters, unicode escapes and
+# other escapes.
+JSON_STRING_TOKEN = re.compile(r'[^"\\]+|\\u[0-9a-fA-F]{4}|\\[^u]')
+
+# Start of a string result in a json-rpc response.
+JSON_RESULT_START = re.compile(r'"result"\s*:\s*"')
+
+# Start of an array result in a json-rpc response, separators of its
+# elements and characters following a complete element.
+JSON_ARRAY_START = re.compile(r'"result"\s*:\s*\[')
+JSON_ARRAY_SEPARATOR = re.compile(r'[\s,]*')
+JSON_ARRAY_END = (',', ']', ' ', '\t', '\n', '\r')
+
+# Size of the response chunks relayed by the broker and read from streamed
+# responses.
+CHUNK_SIZE = 65536
+
+# Seconds to wait for a newly started broker to accept connections.
+BROKER_START_TIMEOUT = 5
+
+# Module params the broker is started with. Tasks passing other values are
+# relayed by a broker of their own, see connect_broker.
+BROKER_PARAMS = ('connect_timeout', 'read_timeout', 'retries', 'retry_backoff',
+                 'rate_limit_reads', 'rate_limit_writes', 'rate_limit_latency',
+                 'workers', 'persistent_timeout')
+
+
+class ZabbixConfig(object):
+
+    def __init__(self, module, metrics=None, defer_login=False):
+
+        # api url
+        self.zbx_url = module.params["zabbix_url"]
+        self.zbx_user = module.params["zabbix_user"]
+        self.zbx_password = module.params["zabbix_password"]
+
+        # zbx request_id counter
+        self.zbx_request_id = 0
+        self.zbx_request = None
+
+        # to avoid error on first query
+        self.auth = None
+        # error response of the last failed relogin, see relogin
+        self.login_error = None
+
+        # passing the module fail_json fct allow error handling in do_request
+        # method
+        self.fail_json = module.fail_json
+
+        # request id counter and auth token are shared by the worker threads.
+        # Lock is reentrant as relogin builds the login request holding it.
+        self.lock = threading.RLock()
+        self.workers = module.params["workers"]
+        self.pool = None
+
+        # max number of objects fetched by a get, see iter_objects
+        self.page_size = module.params["page_size"]
+
+        # trigger expressions expanded by zabbix, or locally from the raw
+        # expressions and their functions, see get_params
+        self.expand_expressions = module.params["expand_expressions"]
+
+        # fast_json: accelerated json backend, and results of paginated gets
+        # decoded from the response stream as they are consumed
+        self.codec = JsonCodec(module.params["fast_json"])
+        self.stream_results = module.params["fast_json"]
+
+        # timing and payload size of every request, see report_metrics
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        self.transport = Transport(self.zbx_url, module.params)
+
+        # large request bodies are gzip compressed until the server fails to
+        # parse one, see post
+        self.compress_requests = module.params["compress_requests"]
+
+        # requests can be relayed by a broker process keeping its session,
+        # connections and auth token across module invocations
+        self.broker = None
+        if module.params["persistent"]:
+            self.broker = connect_broker(module, self.zbx_url, self.zbx_user)
+
+        # # inject proxy for debugging
+        # proxies = {'http': 'http://localhost:8080'}
+        # self.transport.session.proxies = proxies
+
+        # the auth token can be persisted on disk to be shared across module
+        # invocations. File is keyed by url, user and password, hashed, so
+        # that a token is never reused with other credentials.
+        self.auth_cache_file = None
+        if module.params["auth_cache"]:
+            self.auth_cache_file = os.path.join(
+                os.path.expanduser(module.params["cache_dir"]),
+                "auth-{}.json".format(
+                    cache_key(self.zbx_url, self.zbx_user,
+                              self.zbx_password)))
+
+        # name to id resolution cache, shared by module invocations. File is
+        # keyed by url.
+        self.id_cache = None
+        if module.params["id_cache"]:
+            self.id_cache = IdCache(
+                os.path.join(os.path.expanduser(module.params["cache_dir"]),
+                             "ids-{}.json".format(cache_key(self.zbx_url))),
+                module.params["id_cache_ttl"],
+                module.params["id_cache_size"],
+                module.params["refresh_cache"])
+
+        # get requests served from a local dump of the objects, see Snapshot.
+        # The snapshot task itself reads from zabbix.
+        self.snapshot = None
+        if (module.params["snapshot"] and
+                module.params.get("api") != 'snapshot'):
+            self.snapshot = Snapshot(module.params["snapshot"])
+
+        # digest of the objects last applied, to skip reading them again, see
+        # Ledger. File is keyed by url. Only zabbix_config tasks apply objects.
+        self.ledger = None
+        if module.params.get("ledger"):
+            self.ledger = Ledger(
+                os.path.join(os.path.expanduser(module.params["cache_dir"]),
+                             "ledger-{}.json".format(cache_key(self.zbx_url))),
+                module.params["ledger_ttl"],
+                module.params["refresh_cache"])
+
+        # with a snapshot, a ledger or cached facts, tasks may not send any
+        # request: login is deferred to the first request built for zabbix,
+        # see build_request
+        self.defer_login = (defer_login or
+                            self.snapshot is not None or
+                            self.ledger is not None)
+        if not self.defer_login:
+            self.authenticate()
+
+    def authenticate(self):
+        """
+        Register the auth token to use with api.
+
+        A cached token is reused if user.checkAuthentication still accepts
+        it. Otherwise, a new one is obtained through user.login.
+
+        With a broker, its token is used as is. If it was terminated in the
+        meantime, requests will log in again, see post.
+        """
+        if self.broker is not None:
+            token = self.broker.get_auth()
+            if token is not None:
+                self.auth = token
+                return
+
+        token = self.read_auth_cache()
+
+        if token is not None:
+            self.prepare_request('user.checkAuthentication',
+                                 {'sessionid': token})
+            resp = self.do_request(fail_on_error=False)
+            if 'error' not in resp:
+                self.auth = token
+                return
+
+        self.check_response(self.login())
+
+    def login(self):
+        """
+        Authenticate through user.login and register the auth token.
+
+        The token is written to the auth cache if enabled. Errors are not
+        checked here as relogin runs in the worker threads, where the module
+        must not fail.
+
+        Returns: server json response of user.login.
+        """
+        # zbx auth is done through it's api
+        self.auth = None
+        self.prepare_request('user.login',
+                             {'user': self.zbx_user,
+                              'password': self.zbx_password}
+                             )
+
+        resp = self.do_request(fail_on_error=False)
+        if 'error' in resp:
+            return resp
+
+        # register the auth token to use with api
+        self.auth = resp['result']
+        self.write_auth_cache(self.auth)
+        if self.broker is not None:
+            self.broker.set_auth(self.auth)
+        return resp
+
+    def relogin(self, auth):
+        """
+        Replace an auth token terminated server side.
+
+        auth: the token rejected by zabbix. Concurrent requests may all be
+        rejected at once, only the first one to get here logs in again.
+
+        Returns: tuple of the token to replay the request with, and the error
+        response of user.login if it failed, None otherwise.
+        """
+        with self.lock:
+            if self.auth == auth:
+                # login overwrites the request kept for debugging output
+                zbx_request = self.zbx_request
+                resp = self.login()
+                self.zbx_request = zbx_request
+                self.login_error = resp if 'error' in resp else None
+            if self.auth is None:
+                return None, self.login_error
+            return self.auth, None
+
+    def read_auth_cache(self):
+        """
+        Read the auth token from the auth cache file.
+
+        Returns: cached token or None if cache is disabled, missing or
+        unreadable.
+        """
+        if self.auth_cache_file is None:
+            return None
+
+        try:
+            with open(self.auth_cache_file) as f:
+                return json.load(f)['auth']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def write_auth_cache(self, token):
+        """
+        Write the auth token to the auth cache file.
+
+        The file is only readable by its owner. It is written to a temporary
+        file first, then renamed, so concurrent tasks never read a partial
+        token.
+        """
+        if self.auth_cache_file is None:
+            return
+
+        write_private_file(self.auth_cache_file,
+                           json.dumps({'url': self.zbx_url,
+                                       'user': self.zbx_user,
+                                       'auth': token}))
+
+    def prepare_request(self, zbx_method, zbx_params=None, extra_params=None):
+        """
+        Prepare request's json payload.
+
+        Purpose of this is to save to internal variable for ansible -vvv
+        debugging output and allow functionning of check_mode.
+        Extra params will be merged. Array params (bulk create, update or
+        delete) are passed as is.
+        """
+        self.zbx_request = self.build_request(zbx_method, zbx_params,
+                                              extra_params)
+
+    def build_request(self, zbx_method, zbx_params=None, extra_params=None):
+        """
+        Build a request's json payload with its own request id.
+
+        Requests are built in the main thread, where a deferred login is
+        done, so that its failure can fail the module.
+        See prepare_request for params.
+        """
+        if isinstance(zbx_params, list):
+            p = list(zbx_params)
+        else:
+            p = zbx_params.copy()
+            if extra_params is not None:
+                p.update(extra_params)
+
+        if (self.defer_login and self.auth is None and
+                zbx_method not in ZBX_AUTH_METHODS and
+                not (self.snapshot is not None and
+                     self.snapshot.answers(zbx_method, p))):
+            self.deferred_auth()
+
+        with self.lock:
+            self.zbx_request_id += 1
+            request_id = self.zbx_request_id
+
+        return dict(jsonrpc=2.0,
+                    id=request_id,
+                    method=zbx_method,
+                    params=p,
+                    auth=self.auth
+                    )
+
+    def do_request(self, fail_on_error=True):
+        """
+        Perform post request to zabbix api.
+
+        zbx_method: zabbix api method
+        zbx_params: content of zabbix params, not to be confused with requests
+        params.
+        fail_on_error: when False, api errors are returned to the caller
+        instead of failing the module.
+
+        Returns: server json response
+        """
+        resp = self.post(self.zbx_request)
+
+        if fail_on_error:
+            self.check_response(resp)
+        return resp
+
+    def post(self, zbx_request, stream=False, receive=None):
+        """
+        Post a json payload to zabbix api.
+
+        Safe to call from several threads at once. If the auth token was
+        terminated server side, a new one is obtained and the request is sent
+        once more. Likewise if a compressed request could not be parsed,
+        compression is disabled and the request sent uncompressed.
+        stream: decode the result array as it is consumed, see send_stream.
+        receive: consume the response as it is received, see send_receive.
+
+        Gets of the object types of the snapshot, if any, are answered from
+        it. Writes are recorded to it.
+
+        Returns: server json response, api errors included.
+        """
+        if self.snapshot is not None:
+            resp = self.snapshot.answer(zbx_request)
+            if resp is not None:
+                return resp
+
+        compress_requests = self.compress_requests
+        resp = self.send(zbx_request, stream, receive)
+
+        # nothing was done by zabbix, the request can be sent again
+        if ('error' in resp and compress_requests and
+                resp['error'].get('code') == ZBX_PARSE_ERROR):
+            self.compress_requests = False
+            resp = self.send(zbx_request, stream, receive)
+
+        if ('error' in resp and zbx_request['auth'] is not None and
+                ZBX_SESSION_TERMINATED in str(resp['error'].get('data'))):
+            auth, error = self.relogin(zbx_request['auth'])
+            if error is not None:
+                return error
+            zbx_request = dict(zbx_request, auth=auth)
+
+            resp = self.send(zbx_request, stream, receive)
+
+        if self.id_cache is not None and 'error' not in resp:
+            self.invalidate_id_cache(zbx_request['method'])
+
+        if self.snapshot is not None and 'error' not in resp:
+            self.snapshot.record(zbx_request['method'], zbx_request['params'],
+                                 resp['result'])
+
+        return resp
+
+    def deferred_auth(self):
+        """
+        Authenticate on the first request built for zabbix, when login was
+        deferred.
+        """
+        with self.lock:
+            # authenticate overwrites the request kept for debugging output
+            zbx_request = self.zbx_request
+            self.authenticate()
+            self.zbx_request = zbx_request
+
+    def send(self, zbx_request, stream=False, receive=None):
+        """
+        Send a json payload to zabbix api and record its metrics.
+
+        The payload is encoded once, to bytes passed as is to the transport.
+        stream: decode the result array as it is consumed, see send_stream.
+        receive: consume the response as it is received, see send_receive.
+
+        Returns: server json response.
+        """
+        body = self.codec.dumps(zbx_request)
+        if receive is not None:
+            return self.send_receive(zbx_request['method'], body, receive)
+        if stream:
+            return self.send_stream(zbx_request['method'], body)
+
+        start = timer()
+        try:
+            content = b''.join(self.stream(body, zbx_request['method']))
+        except (RequestException, BrokerError) as e:
+            # response interrupted
+            content = transport_error(e)
+        duration = timer() - start
+
+        start = timer()
+        resp = self.codec.loads(content)
+        decode = timer() - start
+
+        self.metrics.record(zbx_request['method'], duration, len(body),
+                            len(content), decode)
+        return resp
+
+    def send_stream(self, zbx_method, body):
+        """
+        Send an encoded json payload to zabbix api, the result array of the
+        response being decoded as it is consumed.
+
+        Only the response chunk being decoded and the current element are
+        held in memory. Metrics are recorded once the result is consumed,
+        duration being the time spent waiting for the response.
+
+        Returns: server json response. Its result is a generator of the
+        elements of the array. Other results and api errors are decoded at
+        once.
+        """
+        stats = dict(duration=0.0, received=0)
+
+        def receive(chunks, decoder=codecs.getincrementaldecoder('utf-8')()):
+            while True:
+                start = timer()
+                chunk = next(chunks, None)
+                stats['duration'] += timer() - start
+                if chunk is None:
+                    # decoding is interleaved with the transfer
+                    self.metrics.record(zbx_method, stats['duration'],
+                                        len(body), stats['received'], 0.0)
+                    return
+                stats['received'] += len(chunk)
+                yield decoder.decode(chunk)
+
+        elements = iter_json_array(receive(self.stream(body, zbx_method)))
+        resp = next(elements)
+        if resp is None:
+            resp = dict(result=elements)
+        return resp
+
+    def send_receive(self, zbx_method, body, receive):
+        """
+        Send an encoded json payload to zabbix api, the response being
+        consumed by receive as it is received.
+
+        receive: called with an iterator of the response text chunks, returns
+        a server json response shaped dict. It is called again if the request
+        is sent again, see post.
+
+        Metrics are recorded once the response is consumed, decoding being
+        interleaved with the transfer.
+
+        Returns: the response returned by receive.
+        """
+        received = [0]
+
+        def decode(chunks, decoder=codecs.getincrementaldecoder('utf-8')()):
+            for chunk in chunks:
+                received[0] += len(chunk)
+                yield decoder.decode(chunk)
+
+        start = timer()
+        chunks = self.stream(body, zbx_method)
+        try:
+            resp = receive(decode(chunks))
+        except (RequestException, BrokerError) as e:
+            # response interrupted
+            resp = self.codec.loads(transport_error(e))
+        finally:
+            chunks.close()
+
+        self.metrics.record(zbx_method, timer() - start, len(body),
+                            received[0], 0.0)
+        return resp
+
+    def stream(self, body, zbx_method):
+        """
+        Post an encoded json payload to zabbix api, through the broker if
+        any.
+
+        Requests of idempotent methods are retried on transient failures, see
+        Transport. Large bodies are compressed with compress_requests.
+
+        Yields: response body, by chunks of bytes, as it is received. A
+        request failing before its response is received gets an api error
+        response.
+        """
+        idempotent = is_idempotent(zbx_method)
+        compressed = self.compress_requests and len(body) >= COMPRESS_MIN_SIZE
+        if compressed:
+            body = gzip_body(body)
+
+        if self.broker is not None:
+            flags = ('i' if idempotent else '') + ('z' if compressed else '')
+            for chunk in self.broker.stream(body, 'post', flags or '-'):
+                yield chunk
+            return
+
+        try:
+            r = self.transport.post(body, idempotent, compressed)
+        except TransportError as e:
+            yield transport_error(e)
+            return
+
+        try:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                yield chunk
+        finally:
+            r.close()
+
+    def invalidate_id_cache(self, zbx_method):
+        """
+        Drop cached ids of the object types created or deleted by a method.
+        """
+        if zbx_method == 'configuration.import':
+            for object_type in ZBX_IMPORT_TYPES:
+                self.id_cache.invalidate(object_type)
+            return
+
+        api, _, action = zbx_method.rpartition('.')
+        if action in ('create', 'delete'):
+            self.id_cache.invalidate(api)
+
+    def check_response(self, resp):
+        """
+        Fail the module if zabbix api returned an error.
+        """
+        # unsucessful login attemps returns a http 200 rc. we must examine
+        # returned json for success or failure.
+        if 'error' in resp:
+            self.fail_json(
+                msg="Zabbix API error: {}".format(
+                    resp['error']['data']))
+
+    def submit(self, zbx_method, zbx_params=None, extra_params=None,
+               stream=False):
+        """
+        Send a request in the background, on the thread pool.
+
+        Same params as prepare_request. Requests are sent concurrently by at
+        most `workers` threads sharing the session connection pool.
+        stream: decode the result array as it is consumed, see send_stream.
+
+        Returns: a pending request to pass to gather.
+        """
+        self.zbx_request = self.build_request(zbx_method, zbx_params,
+                                              extra_params)
+
+        return self.run_async(self.post, (self.zbx_request, stream))
+
+    def run_async(self, func, args):
+        """
+        Run a function in the background, on the thread pool.
+
+        func must return a server json response, or a dict shaped alike, to
+        be checked by gather.
+
+        Returns: a pending request to pass to gather.
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+
+        return self.pool.apply_async(func, args)
+
+    def gather(self, pending, fail_on_error=True):
+        """
+        Wait for requests sent with submit.
+
+        pending: list of pending requests, as returned by submit.
+        fail_on_error: when False, api errors are returned to the caller
+        instead of failing the module. Errors are checked here, in the main
+        thread, as fail_json exits the process.
+
+        Returns: list of server json responses, in the order of pending.
+        """
+        resps = [p.get() for p in pending]
+
+        if fail_on_error:
+            for resp in resps:
+                self.check_response(resp)
+        return resps
+
+    def get_objects(self, api, api_args, filter=None, hostids=None):
+        """
+        Retrieve one or multiple zabbix objects.
+
+        See get_params for params.
+        """
+        zbx_params = self.get_params(api, api_args, filter, hostids)
+        self.prepare_request("{}.get".format(api), zbx_params)
+        resp = self.do_request()
+
+        if 'selectFunctions' in zbx_params:
+            resp['result'] = [expand_trigger(t) for t in resp['result']]
+        return resp
+
+    def iter_objects(self, api, zbx_params):
+        """
+        Retrieve zabbix objects by pages of at most page_size objects.
+
+        zabbix api has no range filter on ids, nor offset. The first page is
+        fetched with limit. If full, the ids of all matching objects are
+        fetched, then the objects not seen yet, by pages of ids. The next
+        page is requested while the current one is consumed, so that at
+        most two pages are held in memory.
+
+        The first page is requested right away, in the background. Several
+        object types may thus be fetched concurrently, e.g:
+
+            objects = [zbx.iter_objects(api, params) for ...]
+
+        zbx_params: params of the get request, see get_params
+
+        Returns: a generator of objects.
+        """
+        zbx_params = dict(zbx_params, limit=self.page_size)
+        zbx_objects = self.iter_pages(
+            api, zbx_params, self.submit("{}.get".format(api), zbx_params,
+                                         stream=self.stream_results))
+
+        if 'selectFunctions' in zbx_params:
+            return (expand_trigger(t) for t in zbx_objects)
+        return zbx_objects
+
+    def iter_pages(self, api, zbx_params, first):
+        id_string = get_id_string(api)
+
+        seen = set()
+        for zbx_object in self.gather([first])[0]['result']:
+            seen.add(zbx_object[id_string])
+            yield zbx_object
+        if len(seen) < self.page_size:
+            return
+
+        # same request, projected on the id only
+        ids_params = dict((k, v) for k, v in zbx_params.items()
+                          if not k.startswith('select') and
+                          k not in ('output', 'limit'))
+        ids_params['output'] = [id_string]
+        self.prepare_request("{}.get".format(api), ids_params)
+        ids = [zbx_object[id_string]
+               for zbx_object in self.do_request()['result']
+               if zbx_object[id_string] not in seen]
+        del seen
+
+        pages = [dict(zbx_params, limit=len(page_ids),
+                      **{id_string + 's': page_ids})
+                 for page_ids in chunks(ids, self.page_size)]
+
+        pending = None
+        for i, page_params in enumerate(pages):
+            if pending is None:
+                pending = self.submit("{}.get".format(api), page_params,
+                                      stream=self.stream_results)
+            current = pending
+            pending = None
+            if i + 1 < len(pages):
+                pending = self.submit("{}.get".format(api), pages[i + 1],
+                                      stream=self.stream_results)
+
+            for zbx_object in self.gather([current])[0]['result']:
+                yield zbx_object
+
+    def get_params(self, api, api_args, filter=None, hostids=None):
+        """
+        Build params of a get request for one or multiple zabbix objects.
+
+        api: zabbix api to use
+        api_args: a dict or list of dict, each dict contain valid zabbix params
+        filter: a dict containing filters that will be injected literally
+            e.g: filter={"hostid": 10153} will result in:
+                    "method": "item.get",
+                    "params": [
+                        {
+                        "filter": {
+                            "hostid": 10153
+                        },
+                        ...
+        hostids: list of host or template ids. When passed, every object
+            belonging to those hosts is returned, regardless of its
+            ZBX_API_UID value.
+
+        NOTE: Zabbix api get methods do not accept arrays. Bulk query is
+                done by passing an array of values to the filter instead.
+        """
+        uid = ZBX_API_UID[api]
+
+        if isinstance(api_args, list):
+            # bulk query: zabbix filter accepts an array of values
+            uid_value = [a[uid] for a in api_args]
+            hostid = [a["hostid"] for a in api_args if "hostid" in a]
+        else:
+            uid_value = api_args[uid]
+            hostid = api_args.get("hostid")
+
+        # zbx_params = api_args
+        zbx_params = {}
+        # zbx_params[ZBX_API_UID[api]] = api_args[ZBX_API_UID[api]]
+
+        # this is kind of hackish, but will plug a filter criteria by the name
+        # of a key found in api_args. Unique key for each api is defined in
+        # ZBX_API_UID hash.
+        if hostids is None:
+            zbx_params["filter"] = {uid: uid_value}
+        else:
+            zbx_params["filter"] = {}
+            zbx_params["hostids"] = hostids
+            # objects inherited from linked templates are managed by their
+            # own template
+            zbx_params["inherited"] = False
+
+        # add extra filter from dict
+        if filter is not None:
+            zbx_params["filter"].update(filter)
+
+        # see also:
+        # https://www.zabbix.com/documentation/3.2/manual/api/reference_commentary#common_get_method_parameters
+
+        # only fetch the fields that will be compared
+        zbx_params.update(get_projection(api, api_args))
+
+        if hostid:
+            zbx_params["filter"]["hostid"] = hostid
+
+        if api == "trigger":
+            zbx_params["templated"] = True
+            if self.expand_expressions:
+                zbx_params["expandExpression"] = True
+            else:
+                # raw expressions are cheaper to get, they are expanded
+                # locally, see expand_trigger
+                for option, fields in ZBX_TRIGGER_SELECTS.items():
+                    if isinstance(zbx_params.get(option), list):
+                        fields = sorted(set(fields + zbx_params[option]))
+                    zbx_params[option] = fields
+
+        if api == "configuration.export":
+            pass
+
+        return zbx_params
+
+    # def update_params(self, api_args, zbx_objects):
+    #     """
+    #     Compute required update for a list of zabbix objects.
+
+    #     api_args: list of zabbix new objects
+    #     zbx_objects: object reference retreived from zabbix. Will contain more
+    #                     objects than api_args
+
+    #     Return a modified api_args where each index only contains values to be
+    #     updated.
+    #     """
+
+    #     # if isinstance(api_args, list):
+    #     #     zbx_params = [self.json_diff(api, api_arg)
+    #     #                   for api_arg in api_args]
+    #     # elif isinstance(api_args, dict):
+    #     #     zbx_params = {}
+    #     #     zbx_params = self.json_diff(api, api_args)
+    #     pass
+
+
+def cache_key(*parts):
+    """
+    Make a file name safe key from a list of strings.
+
+    Used to key cache files by zabbix url, user, object,...
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def write_private_file(path, content):
+    """
+    Atomically write content to a file only readable by its owner.
+
+    Parent directory is created with restrictive permissions if missing.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        # mkstemp already creates the file with 0600 permissions
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def update_json_file(path, change):
+    """
+    Apply a change to a json file shared by module invocations.
+
+    The file is re-read under an exclusive lock, so that concurrent tasks
+    do not lose each other changes, then written with write_private_file.
+    A missing or unreadable file reads as an empty dict.
+
+    change: called with the content of the file, to update in place. Its
+    return value is returned.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            with open(path) as f:
+                content = json.load(f)
+        except (IOError, OSError, ValueError):
+            content = {}
+
+        result = change(content)
+
+        write_private_file(path, json.dumps(content))
+        return result
+
+
+class Metrics(object):
+    """
+    Timing and payload size of the requests sent to zabbix api.
+
+    Every request records its method, duration (round trip, response body
+    included), request and response bytes, and json decode time.
+    """
+
+    def __init__(self):
+        # requests are recorded from the thread pool
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def record(self, method, duration, sent, received, decode):
+        with self.lock:
+            self.calls.append(dict(method=method,
+                                   duration=duration,
+                                   sent=sent,
+                                   received=received,
+                                   decode=decode))
+
+    def summary(self):
+        """
+        Summarize recorded requests, in total and per method.
+
+        Returns: dict with totals and, per method, call count, durations
+        (total, p50, p95), bytes and decode time.
+        """
+        def totals(calls):
+            return dict(calls=len(calls),
+                        duration=sum(c['duration'] for c in calls),
+                        sent=sum(c['sent'] for c in calls),
+                        received=sum(c['received'] for c in calls),
+                        decode=sum(c['decode'] for c in calls))
+
+        by_method = {}
+        for c in self.calls:
+            by_method.setdefault(c['method'], []).append(c)
+
+        methods = {}
+        for method, calls in by_method.items():
+            durations = sorted(c['duration'] for c in calls)
+            methods[method] = totals(calls)
+            methods[method]['p50'] = percentile(durations, 50)
+            methods[method]['p95'] = percentile(durations, 95)
+
+        return dict(totals=totals(self.calls), methods=methods)
+
+    def dump(self, path, **extra):
+        """
+        Append recorded requests to a file, one json line per request.
+
+        extra: fields added to every line, e.g zabbix url and module api.
+        Lines are written at once in append mode, so that concurrent tasks
+        can share the file.
+        """
+        now = time.time()
+        lines = ''.join(json.dumps(dict(c, time=now, **extra)) + '\n'
+                        for c in self.calls)
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of a sorted list.
+    """
+    if not values:
+        return None
+    return values[max(int(math.ceil(len(values) * p / 100.0)) - 1, 0)]
+
+
+def report_metrics(module, metrics, api):
+    """
+    Add the zabbix_metrics summary to the module result.
+
+    exit_json and fail_json of module are wrapped, so that every way out of
+    the module reports metrics. Requests are also appended to metrics_file
+    if set, labelled with api.
+
+    Called before ZabbixConfig is built with metrics, so that a failed
+    login reports them too.
+    """
+    def wrap(func):
+        def report(**kwargs):
+            if module.params['metrics_file']:
+                metrics.dump(module.params['metrics_file'],
+                             url=module.params['zabbix_url'],
+                             api=api)
+            kwargs['zabbix_metrics'] = metrics.summary()
+            func(**kwargs)
+        return report
+
+    module.exit_json = wrap(module.exit_json)
+    module.fail_json = wrap(module.fail_json)
+
+
+class Profiler(object):
+    """
+    cProfile and tracemalloc profiling of the module execution.
+
+    kinds: list holding cpu and/or memory
+    directory: where the pstats dump and the allocation report are written
+    top: number of entries of the allocation report
+
+    Enabled through the ZABBIX_CONFIG_PROFILE environment variable, which
+    covers the whole execution of main (argument parsing included), or
+    through the profile module option, which starts once arguments are
+    parsed.
+    """
+
+    def __init__(self, kinds, directory, top=25):
+        self.kinds = kinds
+        self.directory = os.path.expanduser(directory)
+        self.top = top
+        self.cpu = None
+        self.prefix = os.path.join(
+            self.directory,
+            "zabbix_config-{}-{}".format(
+                time.strftime('%Y%m%d%H%M%S'), os.getpid()))
+
+    def start(self):
+        if 'memory' in self.kinds and HAS_TRACEMALLOC:
+            tracemalloc.start()
+        if 'cpu' in self.kinds:
+            self.cpu = cProfile.Profile()
+            self.cpu.enable()
+
+    def stop(self):
+        """
+        Stop profiling and write reports.
+
+        Returns: short summary of the reports, for the module result.
+        """
+        summary = {}
+        if self.cpu is not None:
+            self.cpu.disable()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # the memory snapshot is taken first, loading pstats allocates a lot
+        if 'memory' in self.kinds and HAS_TRACEMALLOC and \
+                tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            allocations = snapshot.statistics('lineno')[:self.top]
+            path = self.prefix + '-allocations.txt'
+            with open(path, 'w') as f:
+                f.write("peak: {} bytes, current: {} bytes\n".format(
+                    peak, current))
+                for stat in allocations:
+                    f.write("{}\n".format(stat))
+
+            summary['memory'] = dict(
+                report=path,
+                peak=peak,
+                current=current,
+                top=[str(stat) for stat in allocations[:5]])
+
+        if self.cpu is not None:
+            path = self.prefix + '.pstats'
+            self.cpu.dump_stats(path)
+
+            stats = pstats.Stats(path)
+            functions = sorted(stats.stats.items(),
+                               key=lambda f: f[1][3], reverse=True)
+            summary['cpu'] = dict(
+                pstats=path,
+                total_time=stats.total_tt,
+                top=["{}:{}({}) {:.3f}s in {} calls".format(
+                    func[0], func[1], func[2], cumtime, ncalls)
+                    for func, (cc, ncalls, tottime, cumtime, callers)
+                    in functions[:5]])
+            self.cpu = None
+
+        return summary
+
+
+# Profiler started before main, from the environment.
+PROFILER = None
+
+
+def start_env_profiler():
+    """
+    Start a Profiler before the module runs, if ZABBIX_CONFIG_PROFILE is set.
+
+    e.g ZABBIX_CONFIG_PROFILE=cpu,memory to profile argument parsing too
+    """
+    global PROFILER
+
+    if os.environ.get('ZABBIX_CONFIG_PROFILE'):
+        PROFILER = Profiler(
+            os.environ['ZABBIX_CONFIG_PROFILE'].split(','),
+            os.environ.get('ZABBIX_CONFIG_PROFILE_DIR',
+                           '~/.cache/zabbix_config/profiles'),
+            int(os.environ.get('ZABBIX_CONFIG_PROFILE_TOP', 25)))
+        PROFILER.start()
+
+
+def report_profile(module):
+    """
+    Add the zabbix_profile summary to the module result.
+
+    Starts a Profiler if requested by module options and none was started
+    from the environment. exit_json and fail_json are wrapped, see
+    report_metrics.
+    """
+    global PROFILER
+
+    if PROFILER is None and module.params['profile']:
+        PROFILER = Profiler(module.params['profile'],
+                            module.params['profile_dir'],
+                            module.params['profile_top'])
+        PROFILER.start()
+
+    if PROFILER is None:
+        return
+
+    profiler = PROFILER
+
+    def wrap(func):
+        def report(**kwargs):
+            global PROFILER
+            PROFILER = None
+            kwargs['zabbix_profile'] = profiler.stop()
+            func(**kwargs)
+        return report
+
+    module.exit_json = wrap(module.exit_json)
+    module.fail_json = wrap(module.fail_json)
+
+
+class TransportError(Exception):
+    pass
+
+
+class Transport(object):
+    """
+    HTTP transport of api requests.
+
+    A keep-alive session, with a pool of connections sized for the worker
+    threads. Requests time out, see connect_timeout and read_timeout. The
+    ones of idempotent methods are retried on connection errors, timeouts
+    and transient HTTP errors, up to retries times, with jittered
+    exponential backoff. Responses are gzip compressed by the server if it
+    supports it. Requests can be rate limited, see RateLimiter.
+    """
+
+    def __init__(self, url, params):
+        self.url = url
+        self.timeout = (params['connect_timeout'], params['read_timeout'])
+        self.retries = params['retries']
+        self.retry_backoff = params['retry_backoff']
+
+        # request rate shared by all module invocations and brokers of the
+        # controller sending requests to the same zabbix url
+        self.limiter = None
+        if params['rate_limit_reads'] > 0 or params['rate_limit_writes'] > 0:
+            self.limiter = RateLimiter(
+                os.path.join(os.path.expanduser(params['cache_dir']),
+                             "ratelimit-{}.json".format(cache_key(url))),
+                dict(read=params['rate_limit_reads'],
+                     write=params['rate_limit_writes']),
+                params['rate_limit_latency'])
+
+        self.session = Session()
+        self.session.headers.update({'Content-Type': 'application/json-rpc',
+                                     'Cache-Control': 'no-cache',
+                                     'Accept-Encoding': 'gzip'})
+
+        # one connection per worker thread, and as many for the streamed
+        # responses consumed while workers send the next requests
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=2 * max(params['workers'], 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, body, idempotent=False, compressed=False):
+        """
+        Post a request body.
+
+        idempotent: retry the request on transient failures
+        compressed: body is gzip compressed
+
+        Returns: the streamed response, its body not read yet. Raises
+        TransportError if no successful response was received.
+        """
+        headers = {'Content-Encoding': 'gzip'} if compressed else None
+        kind = 'read' if idempotent else 'write'
+
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire(kind)
+            start = timer()
+
+            # overload shows as failed requests and server errors, only
+            # client errors are not a sign of it
+            retry = True
+            ok = False
+            try:
+                r = self.session.post(self.url, data=body, headers=headers,
+                                      timeout=self.timeout, stream=True)
+            except (RequestsConnectionError, Timeout) as e:
+                error = str(e)
+            except RequestException as e:
+                error = str(e)
+                retry = False
+            else:
+                if r.status_code < 400:
+                    if self.limiter is not None:
+                        self.limiter.feedback(kind, timer() - start, True)
+                    return r
+                error = "HTTP error {} {}".format(r.status_code, r.reason)
+                retry = r.status_code in RETRY_STATUSES
+                ok = r.status_code < 500 and r.status_code != 429
+                r.close()
+
+            if self.limiter is not None:
+                self.limiter.feedback(kind, timer() - start, ok)
+
+            if not (idempotent and retry and attempt < self.retries):
+                raise TransportError(error)
+
+            # full jitter, so that concurrent requests do not retry together
+            time.sleep(random.uniform(
+                0, min(self.retry_backoff * 2 ** attempt, RETRY_MAX_DELAY)))
+            attempt += 1
+
+
+class RateLimiter(object):
+    """
+    Request rate limit shared by processes, through a token bucket file.
+
+    There is one bucket per kind of request, read (idempotent methods) and
+    write (the others), each allowing limits[kind] requests per second and
+    bursts of as many. A limit of 0 leaves the kind unlimited.
+
+    The rate of a bucket adapts to the load of the server: it is halved when
+    a request fails on a timeout or a transient HTTP error, or when the
+    response takes more than latency seconds to start, and is increased back
+    toward the limit as responses come in time. The state is shared by all
+    processes through the file, so that concurrent tasks slow down together.
+    """
+
+    def __init__(self, path, limits, latency):
+        self.path = path
+        self.limits = limits
+        self.latency = latency
+
+        # buckets are updated from the thread pool
+        self.lock = threading.Lock()
+
+    def acquire(self, kind):
+        """
+        Take a token from the bucket of a kind, waiting for it if the
+        bucket is empty.
+
+        Tokens are reserved under the lock, the wait happens without it:
+        concurrent requests queue up, each waiting for its own token.
+        """
+        limit = self.limits[kind]
+        if limit <= 0:
+            return
+
+        def take(bucket, now):
+            rate = bucket['rate']
+            bucket['tokens'] = min(bucket['tokens'] +
+                                   (now - bucket['time']) * rate,
+                                   max(limit, 1)) - 1
+            bucket['time'] = now
+            return max(-bucket['tokens'] / rate, 0)
+
+        wait = self.update(kind, take)
+        if wait:
+            time.sleep(wait)
+
+    def feedback(self, kind, duration, ok):
+        """
+        Adapt the rate of a kind to the outcome of a request.
+
+        duration: seconds until the response started
+        ok: False if the request failed on a sign of overload
+        """
+        limit = self.limits[kind]
+        if limit <= 0:
+            return
+
+        def adapt(bucket, now):
+            if not ok or duration > self.latency:
+                if now - bucket['backoff'] >= RATE_LIMIT_BACKOFF_INTERVAL:
+                    bucket['rate'] = max(bucket['rate'] / 2,
+                                         limit * RATE_LIMIT_MIN_FRACTION)
+                    bucket['backoff'] = now
+            else:
+                bucket['rate'] = min(bucket['rate'] +
+                                     limit * RATE_LIMIT_INCREASE, limit)
+
+        self.update(kind, adapt)
+
+    def update(self, kind, change):
+        """
+        Apply a change to the bucket of a kind, under an exclusive lock of
+        the bucket file.
+
+        change: called with the bucket and the current time, its return
+        value is returned. A bucket is a dict of tokens, time of last
+        refill, rate and time of last backoff.
+        """
+        limit = self.limits[kind]
+
+        def apply(buckets):
+            now = time.time()
+            bucket = buckets.get(kind)
+            if bucket is None:
+                bucket = dict(tokens=max(limit, 1), time=now, rate=limit,
+                              backoff=0)
+                buckets[kind] = bucket
+
+            # tasks may be given different limits, the one of this task
+            # applies to its requests
+            bucket['rate'] = min(max(bucket['rate'],
+                                     limit * RATE_LIMIT_MIN_FRACTION),
+                                 limit)
+
+            return change(bucket, now)
+
+        with self.lock:
+            return update_json_file(self.path, apply)
+
+
+def is_idempotent(zbx_method):
+    """
+    Tell whether a method can be sent again if its response was lost.
+    """
+    return (zbx_method.endswith('.get') or
+            zbx_method in ZBX_IDEMPOTENT_METHODS)
+
+
+def gzip_body(body):
+    """
+    Returns: body, gzip compressed.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def transport_error(e):
+    """
+    Returns: json-rpc error response body for a request which failed before
+    its response was received. It is reported like an api error.
+    """
+    return json.dumps(dict(
+        jsonrpc='2.0', id=None,
+        error=dict(code=-1, message='Transport error',
+                   data=str(e)))).encode('utf-8')
+
+
+class JsonCodec(object):
+    """
+    Encoding of api requests and decoding of api responses.
+
+    Requests are encoded to bytes. With fast, orjson or ujson is used when
+    installed, the json standard library otherwise.
+    """
+
+    def __init__(self, fast=False):
+        if fast and HAS_ORJSON:
+            self.name = 'orjson'
+            self.dumps = orjson.dumps
+            self.loads = orjson.loads
+        elif fast and HAS_UJSON:
+            self.name = 'ujson'
+            self.dumps = lambda obj: ujson.dumps(obj).encode('utf-8')
+            self.loads = ujson.loads
+        else:
+            self.name = 'json'
+            self.dumps = lambda obj: json.dumps(obj).encode('utf-8')
+            self.loads = lambda content: json.loads(content.decode('utf-8'))
+
+
+class BrokerError(Exception):
+    pass
+
+
+class BrokerClient(object):
+    """
+    Client of a broker process, see BrokerServer.
+
+    Connections to the broker are opened on demand, and kept for the next
+    requests for the life of the module. A connection serves one request at
+    a time, its response may be consumed by another thread than the one
+    which sent the request.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """
+        Returns: a new connection to the broker, a socket and its file.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        return sock, sock.makefile('rb')
+
+    def stream(self, body, kind='post', flags='-'):
+        """
+        Send a request to the broker.
+
+        body: bytes, the json payload to relay to zabbix api, or the auth
+        token to register with kind auth.
+        flags: i if the request is idempotent, z if body is compressed, see
+        Transport.post.
+
+        Yields: response body, by chunks of bytes, as the broker relays them.
+        """
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = self.connect()
+        sock, rfile = conn
+
+        complete = False
+        try:
+            sock.sendall('{} {} {}\n'.format(kind, len(body), flags)
+                         .encode('ascii') + body)
+
+            while True:
+                line = rfile.readline()
+                if not line:
+                    raise BrokerError("connection closed by broker")
+                size = int(line)
+                if size == 0:
+                    complete = True
+                    return
+                chunk = rfile.read(size)
+                if len(chunk) < size:
+                    raise BrokerError("connection closed by broker")
+                yield chunk
+        finally:
+            # the rest of an unread response would be taken as the next one
+            if complete:
+                with self.lock:
+                    self.idle.append(conn)
+            else:
+                rfile.close()
+                sock.close()
+
+    def get_auth(self):
+        """
+        Returns: auth token held by the broker, None if there is none yet.
+        """
+        token = b''.join(self.stream(b'', 'auth')).decode('utf-8')
+        return token or None
+
+    def set_auth(self, token):
+        b''.join(self.stream(token.encode('utf-8'), 'auth'))
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """
+    Serve the requests of a single broker client connection.
+
+    Requests are a "<kind> <size> <flags>" line followed by size bytes of
+    body. The response body is sent as "<size>" lines each followed by size
+    bytes, up to a "0" line.
+    """
+
+    # responses are flushed once complete, not on every chunk
+    wbufsize = -1
+
+    def handle(self):
+        self.server.enter()
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                kind, size, flags = line.split()
+                body = self.rfile.read(int(size))
+                self.server.touch()
+
+                if kind == b'auth':
+                    self.auth(body)
+                else:
+                    self.relay(body, b'i' in flags, b'z' in flags)
+                self.write_chunk(b'')
+                self.wfile.flush()
+        finally:
+            self.server.leave()
+
+    def write_chunk(self, chunk):
+        self.wfile.write('{}\n'.format(len(chunk)).encode('ascii'))
+        self.wfile.write(chunk)
+
+    def auth(self, token):
+        if token:
+            self.server.auth = token
+        elif self.server.auth is not None:
+            self.write_chunk(self.server.auth)
+
+    def relay(self, body, idempotent, compressed):
+        try:
+            r = self.server.transport.post(body, idempotent, compressed)
+        except TransportError as e:
+            self.write_chunk(transport_error(e))
+            return
+
+        try:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                self.write_chunk(chunk)
+        finally:
+            r.close()
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Broker process relaying module requests to zabbix api.
+
+    The broker keeps a keep-alive session to the zabbix frontend and the auth
+    token, so that module invocations of a play skip the TCP/TLS handshake
+    and user.login. It listens on a unix socket only accessible to its owner,
+    and exits once no client has been connected for idle_timeout seconds.
+    """
+
+    daemon_threads = True
+
+    # seconds between two idle checks
+    timeout = 1
+
+    def __init__(self, path, lock_path, zbx_url, params):
+        self.path = path
+        self.lock_path = lock_path
+        self.idle_timeout = params['persistent_timeout']
+        self.auth = None
+
+        self.clients = 0
+        self.last_active = timer()
+        self.clients_lock = threading.Lock()
+
+        # transport settings are the ones of the module starting the broker
+        self.transport = Transport(zbx_url, params)
+
+        socketserver.UnixStreamServer.__init__(self, path, BrokerHandler)
+
+    def enter(self):
+        with self.clients_lock:
+            self.clients += 1
+
+    def leave(self):
+        with self.clients_lock:
+            self.clients -= 1
+            self.last_active = timer()
+
+    def touch(self):
+        self.last_active = timer()
+
+    def serve(self):
+        while self.clients or timer() - self.last_active < self.idle_timeout:
+            self.handle_request()
+
+        # unlinked under the lock, so that a client either connects before,
+        # and is served below, or starts a new broker
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            os.unlink(self.path)
+
+        while select.select([self], [], [], 0)[0]:
+            self.handle_request()
+        while self.clients:
+            time.sleep(self.timeout)
+
+        self.server_close()
+
+
+def connect_broker(module, zbx_url, zbx_user):
+    """
+    Connect to the broker of zabbix url and user, starting it if needed.
+
+    The broker socket lives in cache_dir. Module invocations connecting at
+    the same time are serialized by a lock file, only one starts the broker.
+
+    The broker hands its auth token to its clients without checking their
+    credentials, it is thus keyed by the password as well, hashed along with
+    url and user, and by the transport settings it runs with, see
+    BROKER_PARAMS.
+
+    Returns: a BrokerClient, None if the broker could not be reached. Module
+    then sends its requests itself.
+    """
+    directory = os.path.expanduser(module.params['cache_dir'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    key = cache_key(zbx_url, zbx_user, module.params['zabbix_password'],
+                    *[module.params[p] for p in BROKER_PARAMS])
+    path = os.path.join(directory, "broker-{}.sock".format(key))
+    lock_path = os.path.join(directory, "broker-{}.lock".format(key))
+    client = BrokerClient(path)
+
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            client.idle.append(client.connect())
+            return client
+        except socket.error:
+            pass
+
+        # no broker, or a stale socket left by a killed one
+        if os.path.exists(path):
+            os.unlink(path)
+        start_broker(lock, path, lock_path, zbx_url, module.params)
+
+        deadline = timer() + BROKER_START_TIMEOUT
+        while timer() < deadline:
+            try:
+                client.idle.append(client.connect())
+                return client
+            except socket.error:
+                time.sleep(0.05)
+
+    module.warn("Zabbix config broker could not be started, "
+                "requests are sent without it")
+    return None
+
+
+def start_broker(lock, path, lock_path, zbx_url, params):
+    """
+    Start a BrokerServer in a detached process.
+
+    The process is double forked, so that it is neither waited for nor
+    killed with the module, and its standard streams are closed, so that
+    ansible does not wait for them.
+
+    lock: the lock file held by the caller. Its inherited descriptor is
+    closed, or the lock would be held as long as the broker runs.
+    """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    try:
+        lock.close()
+        os.setsid()
+        if os.fork():
+            return
+
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+
+        # socket is only accessible to its owner
+        os.umask(0o077)
+        BrokerServer(path, lock_path, zbx_url, params).serve()
+    finally:
+        os._exit(0)
+
+
+class IdCache(object):
+    """
+    Persistent name to id resolution cache.
+
+    Entries are stored per object type in a json file shared by all module
+    invocations on the host, and expire after ttl seconds. When the file
+    holds more than size entries, least recently used ones are evicted.
+
+    Reads are served from the file as loaded at startup. Writes re-read the
+    file under an exclusive lock, see update_json_file. Last access times
+    of read entries are saved along with writes.
+    """
+
+    def __init__(self, path, ttl, size, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+
+        # refresh bypasses cached entries, fresh ids are still saved
+        self.refresh = refresh
+
+        # invalidations can come from the thread pool
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        """
+        Read cache entries from file.
+
+        Returns: {object_type: {name: [id, creation time, access time]}}
+        """
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, object_type, name):
+        """
+        Returns: cached id or None if missing, expired or refreshing.
+        """
+        if self.refresh:
+            return None
+
+        entry = self.entries.get(object_type, {}).get(name)
+        now = time.time()
+        if entry is None or now - entry[1] > self.ttl:
+            return None
+
+        entry[2] = now
+        return entry[0]
+
+    def put(self, object_type, name, object_id):
+        now = time.time()
+
+        def change(entries):
+            entries.setdefault(object_type, {})[name] = [object_id, now, now]
+
+        self.update(change)
+
+    def invalidate(self, object_type):
+        # the type may have been cached by another task since startup
+        def change(entries):
+            entries.pop(object_type, None)
+
+        self.update(change)
+
+    def update(self, change):
+        """
+        Apply a change to the cache file, under an exclusive lock.
+
+        Access times recorded in memory are merged, then expired and least
+        recently used entries are evicted.
+        """
+        def apply(entries):
+            for object_type, names in self.entries.items():
+                for name, entry in names.items():
+                    current = entries.get(object_type, {}).get(name)
+                    if current is not None and current[0] == entry[0]:
+                        current[2] = max(current[2], entry[2])
+
+            change(entries)
+
+            now = time.time()
+            flat = []
+            for object_type, names in entries.items():
+                for name, entry in list(names.items()):
+                    if now - entry[1] > self.ttl:
+                        names.pop(name)
+                    else:
+                        flat.append((entry[2], object_type, name))
+
+            flat.sort()
+            for used, object_type, name in flat[:max(len(flat) -
+                                                     self.size, 0)]:
+                entries[object_type].pop(name)
+
+            for object_type in list(entries):
+                if not entries[object_type]:
+                    entries.pop(object_type)
+            self.entries = entries
+
+        with self.lock:
+            update_json_file(self.path, apply)
+
+
+class Ledger(object):
+    """
+    Persistent digest of the objects last applied by the module.
+
+    Entries are stored per object type and key (see ledger_entry) in a json
+    file shared by all module invocations on the host: id of the object and
+    digest of the api_args and state it was last found or made to match. An
+    object whose args hash to the same digest within ttl seconds is trusted
+    to be unchanged, and is not read again.
+
+    Changes made outside of the module, or through its other modes, go
+    unnoticed until the entry expires. refresh bypasses entries, objects are
+    then read and entries written again, repairing any drift.
+
+    Writes re-read the file under an exclusive lock, see update_json_file.
+    """
+
+    def __init__(self, path, ttl, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.entries = self.load()
+
+    def load(self):
+        """
+        Read ledger entries from file.
+
+        Returns: {object_type: {key: [id, digest, time]}}
+        """
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, object_type, key, digest):
+        """
+        Returns: the id of a trusted object, as [id], or None if the entry is
+        missing, expired, of another digest or refreshing. Ids of objects
+        trusted absent are None.
+        """
+        if self.refresh:
+            return None
+
+        entry = self.entries.get(object_type, {}).get(key)
+        if (entry is None or entry[1] != digest or
+                time.time() - entry[2] > self.ttl):
+            return None
+        return [entry[0]]
+
+    def put(self, object_type, entries):
+        """
+        Record objects found or made to match their args.
+
+        entries: list of (key, id, digest)
+        """
+        if not entries:
+            return
+
+        def change(ledger, now):
+            objects = ledger.setdefault(object_type, {})
+            for key, object_id, digest in entries:
+                objects[key] = [object_id, digest, now]
+
+        self.update(change)
+
+    def drop(self, object_type, ids):
+        """
+        Forget objects deleted by id, their args would be trusted otherwise.
+        """
+        ids = set(ids)
+        if not ids:
+            return
+
+        def change(ledger, now):
+            objects = ledger.get(object_type, {})
+            for key, entry in list(objects.items()):
+                if entry[0] in ids:
+                    objects.pop(key)
+
+        self.update(change)
+
+    def update(self, change):
+        """
+        Apply a change to the ledger file, under an exclusive lock, then
+        evict expired entries.
+        """
+        def apply(ledger):
+            now = time.time()
+            change(ledger, now)
+
+            for name in list(ledger):
+                for key, entry in list(ledger[name].items()):
+                    if now - entry[2] > self.ttl:
+                        ledger[name].pop(key)
+                if not ledger[name]:
+                    ledger.pop(name)
+            self.entries = ledger
+
+        update_json_file(self.path, apply)
+
+
+class Snapshot(object):
+    """
+    Local dump of zabbix objects, serving get requests instead of zabbix.
+
+    The snapshot file, written by snapshot_objects, is a gzipped json
+    document holding, per object type, the params of the get request which
+    dumped the objects and the objects. A get of a dumped object type is
+    answered from the snapshot if its filters can be evaluated locally (see
+    SNAPSHOT_GET_PARAMS) and its other params are the ones of the dump. It
+    is sent to zabbix otherwise.
+
+    Writes applied to zabbix are recorded to a journal next to the snapshot,
+    replayed when it is loaded, so that the snapshot stays current across
+    the tasks of a run. Writes whose effect cannot be replayed, e.g
+    host.massadd or the creation of triggers, which are not created with
+    their hostid, drop their object type from the snapshot instead.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.journal = self.path + '.journal'
+
+        # writes are recorded from the thread pool
+        self.lock = threading.Lock()
+        self.types = {}
+        self.time = None
+        self.load()
+
+    def load(self):
+        """
+        Read the snapshot file and replay its journal.
+
+        A missing or unreadable snapshot is empty, every get is then sent to
+        zabbix.
+        """
+        try:
+            with gzip.open(self.path, 'rb') as f:
+                snapshot = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError, EOFError):
+            return
+
+        self.time = snapshot['time']
+
+        # objects are held as records, each type converted in turn, so
+        # that decoded dicts of all types are not held along with them
+        self.records = RecordFactory()
+        for api in list(snapshot['types']):
+            dump = snapshot['types'].pop(api)
+            id_string = get_id_string(api)
+            self.types[api] = dict(
+                params=dump['params'],
+                objects=dict((r[id_string], r) for r in
+                             self.records.convert(dump.pop('objects'))))
+        self.records.clear()
+
+        try:
+            with open(self.journal) as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            lines = []
+
+        for line in lines:
+            try:
+                write = json.loads(line)
+            except ValueError:
+                # partial line of a killed task
+                continue
+            # left by writes to the previous snapshot
+            if write['snapshot'] != self.time:
+                continue
+            self.apply(write['method'], write['params'], write['result'])
+
+    def answer(self, zbx_request):
+        """
+        Returns: server json response shaped dict for a get request answered
+        from the snapshot, None if the request must be sent to zabbix.
+        """
+        api, _, action = zbx_request['method'].rpartition('.')
+        if action != 'get':
+            return None
+
+        with self.lock:
+            result = self.get(api, zbx_request['params'])
+        if result is None:
+            return None
+        return dict(jsonrpc='2.0', id=zbx_request['id'], result=result)
+
+    def answers(self, zbx_method, params):
+        """
+        Returns: True if a request would be answered from the snapshot.
+        """
+        api, _, action = zbx_method.rpartition('.')
+        if action != 'get':
+            return False
+
+        with self.lock:
+            return self.accepts(api, params)
+
+    def accepts(self, api, params):
+        """
+        Returns: True if get params can be evaluated against the dumped
+        objects of a type.
+        """
+        dump = self.types.get(api)
+        if dump is None:
+            return False
+
+        id_string = get_id_string(api)
+        for k in set(params) | set(dump['params']):
+            if k.startswith('select'):
+                # lists are dumped in full
+                if k in params and k not in dump['params']:
+                    return False
+            elif k in dump['params'] and k != 'output':
+                if params.get(k) != dump['params'][k]:
+                    return False
+            elif k not in SNAPSHOT_GET_PARAMS and k != id_string + 's':
+                return False
+
+        if 'groupids' in params and 'selectGroups' not in dump['params']:
+            return False
+        if 'inherited' in params and api not in ZBX_SYNC_ORDER:
+            return False
+        return True
+
+    def get(self, api, params):
+        """
+        Evaluate get params against the objects of a type.
+
+        Returns: list of records, projected on the output fields, None if
+        the type was not dumped or params cannot be evaluated locally.
+        """
+        if not self.accepts(api, params):
+            return None
+
+        dump = self.types[api]
+        id_string = get_id_string(api)
+        wanted = {}
+        for k, v in params.items():
+            if k in ('hostids', 'groupids', id_string + 's'):
+                wanted[k] = set(str(i) for i in as_list(v))
+        filters = [(k, set(str(i) for i in as_list(v)))
+                   for k, v in (params.get('filter') or {}).items()]
+        patterns = [(k, v.lower() if params.get('searchWildcardsEnabled')
+                     else '*{}*'.format(v.lower()))
+                    for k, v in (params.get('search') or {}).items()]
+
+        fields = None
+        if isinstance(params.get('output'), list):
+            fields = set(params['output'])
+            fields.update(ZBX_FIELD_ALIASES.get(f, f)
+                          for f, option in ZBX_SELECTS.items()
+                          if option in params)
+            fields = frozenset(fields)
+
+        result = []
+        limit = params.get('limit')
+        for obj in dump['objects'].values():
+            if limit and len(result) >= int(limit):
+                break
+
+            if 'inherited' in params and \
+                    (obj.get('templateid', '0') != '0') != params['inherited']:
+                continue
+            if any(not (snapshot_ids(api, obj, k) & ids)
+                   for k, ids in wanted.items()):
+                continue
+            if any(not (snapshot_ids(api, obj, k) & values)
+                   if k == 'hostid' else str(obj.get(k)) not in values
+                   for k, values in filters):
+                continue
+            if any(not fnmatch.fnmatchcase(str(obj.get(k, '')).lower(),
+                                           pattern)
+                   for k, pattern in patterns):
+                continue
+
+            if fields is not None:
+                obj = self.records.project(obj, fields)
+            result.append(obj)
+
+        return result
+
+    def record(self, zbx_method, params, result):
+        """
+        Apply a write sent to zabbix to the snapshot, and append it to the
+        journal.
+
+        Lines are written at once in append mode, so that concurrent tasks
+        can share the journal.
+        """
+        api, _, action = zbx_method.rpartition('.')
+        if is_idempotent(zbx_method) or (api not in self.types and
+                                         zbx_method != 'configuration.import'):
+            return
+
+        line = json.dumps(dict(snapshot=self.time, method=zbx_method,
+                               params=params, result=result)) + '\n'
+        with self.lock:
+            self.apply(zbx_method, params, result)
+
+            fd = os.open(self.journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o600)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+
+    def apply(self, zbx_method, params, result):
+        if zbx_method == 'configuration.import':
+            self.types.clear()
+            return
+
+        api, _, action = zbx_method.rpartition('.')
+        dump = self.types.get(api)
+        if dump is None:
+            return
+
+        id_string = get_id_string(api)
+        objects = dump['objects']
+        if action == 'create' and api not in ('trigger', 'graph'):
+            for p, object_id in zip(as_list(params),
+                                    result[id_string + 's']):
+                obj = snapshot_fields(p)
+                obj[id_string] = str(object_id)
+                objects[obj[id_string]] = self.records.record(obj)
+        elif action == 'update':
+            for p in as_list(params):
+                obj = objects.get(str(p[id_string]))
+                if obj is None:
+                    continue
+                obj = dict(obj.items())
+                cleared = set(t.get('templateid')
+                              for t in p.get('templates_clear') or ())
+                if cleared:
+                    obj['parentTemplates'] = [
+                        t for t in obj.get('parentTemplates', [])
+                        if t.get('templateid') not in cleared]
+                obj.update(snapshot_fields(p))
+                objects[obj[id_string]] = self.records.record(obj)
+        elif action == 'delete':
+            for object_id in params:
+                objects.pop(str(object_id), None)
+        else:
+            self.types.pop(api)
+
+
+class Record(tuple):
+    """
+    Compact read-only mapping of the fields of a zabbix object.
+
+    Values are held in a tuple, fields by the record class, one per set of
+    fields, see RecordFactory. A record takes a fraction of the memory of
+    the dict decoded from json. It supports the mapping methods used to
+    read and diff objects, but is not serializable as such: it is turned
+    back to a dict with dict(record.items()).
+    """
+
+    __slots__ = ()
+
+    # field names, and their position in the tuple
+    fields = ()
+    index = {}
+
+    def __getitem__(self, field):
+        return tuple.__getitem__(self, self.index[field])
+
+    def __contains__(self, field):
+        return field in self.index
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def get(self, field, default=None):
+        i = self.index.get(field)
+        if i is None:
+            return default
+        return tuple.__getitem__(self, i)
+
+    def keys(self):
+        return list(self.fields)
+
+    def values(self):
+        return list(tuple.__iter__(self))
+
+    def items(self):
+        return list(zip(self.fields, tuple.__iter__(self)))
+
+
+class RecordFactory(object):
+    """
+    Make Records of zabbix objects.
+
+    Objects with the same fields share the same record class. String
+    values are deduplicated across the records made by the factory: most
+    fields of zabbix objects take a few distinct values ("0", "60",...),
+    held once. The table of values can be dropped with clear once a bulk of
+    records is made.
+    """
+
+    def __init__(self):
+        self.classes = {}
+        self.values = {}
+        # record class and positions of the fields kept, by record fields
+        # and projection, see project
+        self.projections = {}
+
+    def record_class(self, fields):
+        cls = self.classes.get(fields)
+        if cls is None:
+            cls = type(str('Record'), (Record,), dict(
+                __slots__=(),
+                fields=fields,
+                index=dict((f, i) for i, f in enumerate(fields))))
+            self.classes[fields] = cls
+        return cls
+
+    def record(self, obj):
+        """
+        Returns: a record of the fields of a dict.
+        """
+        cls = self.record_class(tuple(obj))
+
+        values = self.values
+        return cls(values.setdefault(v, v) if isinstance(v, TEXT_TYPE) else v
+                   for v in obj.values())
+
+    def project(self, record, fields):
+        """
+        Returns: a record of the fields of a record found in fields, a
+        frozenset. Values are shared with the record.
+        """
+        key = (record.fields, fields)
+        projection = self.projections.get(key)
+        if projection is None:
+            positions = tuple(i for i, f in enumerate(record.fields)
+                              if f in fields)
+            projection = (self.record_class(tuple(record.fields[i]
+                                                  for i in positions)),
+                          positions)
+            self.projections[key] = projection
+
+        cls, positions = projection
+        return cls(tuple.__getitem__(record, i) for i in positions)
+
+    def clear(self):
+        self.values = {}
+
+    def convert(self, objects):
+        """
+        Convert a list of dicts to records, emptying the list as it goes so
+        that dicts are freed as soon as converted.
+
+        Yields: records, in order.
+        """
+        objects.reverse()
+        while objects:
+            yield self.record(objects.pop())
+
+
+def snapshot_fields(params):
+    """
+    Returns: fields of create or update params, as a get would return them.
+    """
+    return dict((ZBX_FIELD_ALIASES.get(k, k), v) for k, v in params.items()
+                if k not in ZBX_WRITE_ONLY)
+
+
+def snapshot_ids(api, obj, option):
+    """
+    Returns: ids of a snapshot object matched by a get <type>ids option or a
+    hostid filter.
+    """
+    if option in ('hostids', 'hostid'):
+        if api in ('trigger', 'graph'):
+            return set(h['hostid'] for h in obj.get('hosts', []))
+        return set([obj.get('hostid', obj[get_id_string(api)])])
+    if option == 'groupids':
+        return set(g['groupid'] for g in obj.get('groups', []))
+    return set([obj[get_id_string(api)]])
+
+
+def as_list(value):
+    """
+    Returns: value as a list, single values as a one element list.
+    """
+    return value if isinstance(value, list) else [value]
+
+
+class ObjectPatch(object):
+    """
+    Minimal set of changes turning an existing zabbix object into a desired
+    one.
+
+    changes: desired value of every field that differs
+    previous: existing value of those fields, None if missing
+    """
+
+    def __init__(self):
+        self.changes = {}
+        self.previous = {}
+
+    def add(self, field, previous, desired):
+        self.changes[field] = desired
+        self.previous[field] = previous
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    # python 2
+    __nonzero__ = __bool__
+
+    def payload(self, ids):
+        """
+        Build update params from the changes.
+
+        ids: fields identifying the object to update, e.g {"itemid": "42"}
+        """
+        p = dict(self.changes)
+        p.update(ids)
+        return p
+
+
+def get_projection(api, api_args):
+    """
+    Build the output and select* params of a get request.
+
+    Zabbix returns all default fields of an object unless told otherwise.
+    Only the fields found in api_args are requested, along with the id and
+    ZBX_API_UID fields. List fields are fetched through their select*
+    option (see ZBX_SELECTS), limited to the fields of their elements and
+    their natural key.
+
+    api_args: a dict or list of dict
+    """
+    if not isinstance(api_args, list):
+        api_args = [api_args]
+
+    output = set([ZBX_API_UID[api], get_id_string(api)])
+    selects = {}
+
+    for api_arg in api_args:
+        for k, v in api_arg.items():
+            if k in ZBX_WRITE_ONLY:
+                continue
+
+            if k not in ZBX_SELECTS:
+                output.add(k)
+                continue
+
+            fields = selects.setdefault(k, set(ZBX_LIST_KEYS.get(k, ())))
+            if isinstance(v, list):
+                for element in v:
+                    if isinstance(element, dict):
+                        fields.update(element)
+
+    zbx_params = dict((ZBX_SELECTS[k], sorted(fields))
+                      for k, fields in selects.items())
+    zbx_params["output"] = sorted(output)
+    return zbx_params
+
+
+def object_diff(current, desired):
+    """
+    Compare an existing zabbix object with desired params.
+
+    current: object as returned by a zabbix get request
+    desired: params of the object, as passed to create or update
+
+    Only fields present in desired are compared. Neither object is altered.
+    Scalars are compared as strings, as zabbix always returns strings. Lists
+    are compared element wise, see same_list.
+
+    Returns: an ObjectPatch, empty (False) if objects are identical.
+    """
+    patch = ObjectPatch()
+
+    for k, v in desired.items():
+        if k in current:
+            c = current[k]
+        elif ZBX_FIELD_ALIASES.get(k) in current:
+            c = current[ZBX_FIELD_ALIASES[k]]
+        else:
+            patch.add(k, None, v)
+            continue
+
+        if not same_value(k, c, v):
+            patch.add(k, c, v)
+
+    return patch
+
+
+def same_value(field, current, desired):
+    """
+    Return True if an existing value matches a desired value.
+
+    field: name of the field holding the values, used to key list elements.
+    """
+    if isinstance(desired, dict):
+        return (isinstance(current, dict) and
+                all(k in current and same_value(k, current[k], v)
+                    for k, v in desired.items()))
+
+    if isinstance(desired, list):
+        return isinstance(current, list) and same_list(field, current, desired)
+
+    # cast to string for the test: zbx always return strings
+    return str(current) == str(desired)
+
+
+def same_list(field, current, desired):
+    """
+    Return True if an existing list matches a desired list.
+
+    Zabbix replaces lists on update, so both must hold the same elements,
+    regardless of their order. Elements are matched through an index on
+    their natural key (see list_key_fields), which makes the comparison
+    linear.
+    """
+    if len(current) != len(desired):
+        return False
+
+    if not all(isinstance(d, dict) for d in desired):
+        return (sorted(scalar_element(field, c) for c in current) ==
+                sorted(str(d) for d in desired))
+
+    # one index of current elements per set of key fields. Usually a single
+    # one as all desired elements share the same fields.
+    indexes = {}
+
+    for d in desired:
+        fields = list_key_fields(field, d)
+        if fields not in indexes:
+            indexes[fields] = dict(
+                (element_key(c, fields), c)
+                for c in current if isinstance(c, dict))
+
+        c = indexes[fields].get(element_key(d, fields))
+        if c is None or not same_value(field, c, d):
+            return False
+
+    return True
+
+
+def list_key_fields(field, element):
+    """
+    Return the fields identifying an element of a list.
+
+    Natural keys are defined in ZBX_LIST_KEYS, e.g groupid for groups. When
+    the element does not hold them (e.g interfaces to create have no
+    interfaceid yet), all of its scalar fields are used.
+    """
+    keys = ZBX_LIST_KEYS.get(field)
+    if keys is not None and all(k in element for k in keys):
+        return keys
+
+    return tuple(sorted(k for k, v in element.items()
+                        if not isinstance(v, (list, dict))))
+
+
+def scalar_element(field, element):
+    """
+    Return an existing list element as compared with scalar desired
+    elements.
+
+    Lists of ids are passed as scalars to create and update, e.g
+    applications=["123"], but returned as objects by get requests, e.g
+    [{"applicationid": "123"}]. Such an element is compared by its natural
+    key, see ZBX_LIST_KEYS.
+    """
+    keys = ZBX_LIST_KEYS.get(field, ())
+    if isinstance(element, dict) and len(keys) == 1 and keys[0] in element:
+        return str(element[keys[0]])
+    return str(element)
+
+
+def element_key(element, fields):
+    """
+    Return the key of a list element made of the values of fields.
+    """
+    return tuple(str(element.get(f)) for f in fields)
+
+
+def expand_trigger(trigger):
+    """
+    Expand the raw expressions of a trigger, as expandExpression would.
+
+    Function references are replaced by {<host>:<key>.<function>(<params>)},
+    through an index of the trigger functions, items and hosts, as selected
+    with ZBX_TRIGGER_SELECTS. The trigger is modified in place, or copied
+    to a dict if it is a read-only Record answered from a snapshot.
+
+    Returns: the trigger.
+    """
+    if isinstance(trigger, Record):
+        trigger = dict(trigger.items())
+
+    hosts = dict((h['hostid'], h['host']) for h in trigger.get('hosts', []))
+    items = dict((i['itemid'], i) for i in trigger.get('items', []))
+
+    functions = {}
+    for f in trigger.get('functions', []):
+        item = items.get(f['itemid'])
+        if item is None or item['hostid'] not in hosts:
+            continue
+        functions[f['functionid']] = "{{{}:{}.{}({})}}".format(
+            hosts[item['hostid']], item['key_'], f['function'],
+            f['parameter'])
+
+    def expand(m):
+        return functions.get(m.group(1), m.group(0))
+
+    for field in ZBX_TRIGGER_EXPRESSIONS:
+        if field in trigger:
+            trigger[field] = TRIGGER_FUNCTION_REF.sub(expand, trigger[field])
+    return trigger
+
+
+def selector_params(module, zbx, api, selector, template_name=None):
+    """
+    Build the params of a get selecting objects of a type.
+
+    selector: a dict with any of
+        names: list of ZBX_API_UID values
+        pattern: wildcard pattern on the ZBX_API_UID value
+        filter: a dict of field values, passed as is to the get filter
+    template_name: only select the children of this template or host
+
+    All given selectors apply. Returns: get params, output excluded.
+    """
+    uid = ZBX_API_UID[api]
+
+    zbx_params = {}
+    if selector.get('filter'):
+        zbx_params['filter'] = dict(selector['filter'])
+    if selector.get('names'):
+        zbx_params.setdefault('filter', {})[uid] = selector['names']
+    if selector.get('pattern'):
+        zbx_params['search'] = {uid: selector['pattern']}
+        zbx_params['searchWildcardsEnabled'] = True
+    if template_name:
+        hostid = (get_object_id(zbx, 'template', template_name) or
+                  get_object_id(zbx, 'host', template_name))
+        if hostid is None:
+            module.fail_json(msg="Template or host not found: {}"
+                             .format(template_name))
+        zbx_params['hostids'] = [hostid]
+    return zbx_params
+
+
+def get_id_string(api):
+    """
+    Return the name of the id field of a zabbix object type.
+
+    e.g: item -> itemid. Quirks are defined in ZBX_API_ID.
+    """
+    return ZBX_API_ID.get(api, "{}id".format(api))
+
+
+def chunks(l, n):
+    """
+    Split a list in successive chunks of at most n elements.
+
+    A chunk size of 0 or less returns the whole list as a single chunk.
+    """
+    if n is None or n <= 0:
+        n = len(l) or 1
+    return [l[i:i + n] for i in range(0, len(l), n)]
+
+
+def iter_json_array(chunks, decoder=json.JSONDecoder()):
+    """
+    Decode the array result of a json-rpc response as it is received.
+
+    chunks: iterable of response text chunks
+
+    First yielded value is None if the result is an array, or the whole
+    decoded response otherwise (e.g an api error). Decoded elements of the
+    array follow, one at a time.
+    """
+    chunks = iter(chunks)
+    text = ''
+    for chunk in chunks:
+        text += chunk
+        m = JSON_ARRAY_START.search(text)
+        if m is not None:
+            break
+        if '"error"' in text:
+            # not an array result, decode it at once
+            yield json.loads(text + ''.join(chunks))
+            return
+    else:
+        yield json.loads(text)
+        return
+
+    yield None
+
+    text = text[m.end():]
+    pos = 0
+    while True:
+        pos = JSON_ARRAY_SEPARATOR.match(text, pos).end()
+        if text.startswith(']', pos):
+            # read the end of the response, releasing its connection
+            for chunk in chunks:
+                pass
+            return
+
+        try:
+            element, end = decoder.raw_decode(text, pos)
+        except ValueError:
+            end = None
+
+        # a number may be truncated, e.g 1500 of 1500.0, an element is
+        # complete once followed by a separator
+        if end is not None and text[end:end + 1] in JSON_ARRAY_END:
+            yield element
+            pos = end
+            continue
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            if end is not None:
+                raise ValueError("Truncated json-rpc response")
+            # raise the decode error
+            decoder.raw_decode(text, pos)
+        text = text[pos:] + chunk
+        pos = 0
+
+
+def get_object_id(zbx, object_type, object_name=None):
+    """
+    Get a zabbix object id.
+
+    zbx: zbx object to interact with zabbix api
+    object_type: kind of the object (item, trigger, template,...)
+    object_name: object name to get the id of.
+
+
+    Ids are served from the id cache when enabled.
+
+    Returns: Object id or None if object_name is None.
+    """
+    if object_name is None:
+        return None
+    else:
+        if object_type == 'group':
+            object_type = 'hostgroup'
+
+        if zbx.id_cache is not None:
+            object_id = zbx.id_cache.get(object_type, object_name)
+            if object_id is not None:
+                return object_id
+
+        res = zbx.get_objects(object_type,
+                              {ZBX_API_UID[object_type]: object_name})
+
+        if len(res['result']) > 0:
+            object_id = res['result'][0][get_id_string(object_type)]
+            if zbx.id_cache is not None:
+                zbx.id_cache.put(object_type, object_name, object_id)
+            return object_id
+        else:
+            return None
+
+
+def zabbix_argument_spec():
+    """
+    Returns: argument spec of the options common to the zabbix modules,
+    connection, transport, caches and reporting.
+    """
+    return dict(
+        zabbix_url=dict(required=True, type="str"),
+        zabbix_user=dict(required=True, type="str"),
+        zabbix_password=dict(required=True, type="str", no_log=True),
+        auth_cache=dict(default=False, type="bool"),
+        cache_dir=dict(default="~/.cache/zabbix_config", type="path"),
+        workers=dict(default=4, type="int"),
+        id_cache=dict(default=False, type="bool"),
+        id_cache_ttl=dict(default=3600, type="int"),
+        id_cache_size=dict(default=10000, type="int"),
+        refresh_cache=dict(default=False, type="bool"),
+        persistent=dict(default=False, type="bool"),
+        persistent_timeout=dict(default=300, type="int"),
+        metrics_file=dict(required=False, type="path"),
+        profile=dict(default=[], type="list",
+                     choices=["cpu", "memory"]),
+        profile_dir=dict(default="~/.cache/zabbix_config/profiles",
+                         type="path"),
+        profile_top=dict(default=25, type="int"),
+        page_size=dict(default=5000, type="int"),
+        fast_json=dict(default=False, type="bool"),
+        connect_timeout=dict(default=10, type="float"),
+        read_timeout=dict(default=300, type="float"),
+        retries=dict(default=3, type="int"),
+        retry_backoff=dict(default=0.5, type="float"),
+        compress_requests=dict(default=False, type="bool"),
+        snapshot=dict(required=False, type="path"),
+        expand_expressions=dict(default=True, type="bool"),
+        rate_limit_reads=dict(default=0, type="float"),
+        rate_limit_writes=dict(default=0, type="float"),
+        rate_limit_latency=dict(default=5, type="float")
+    )
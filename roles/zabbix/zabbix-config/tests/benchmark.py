@@ -0,0 +1,328 @@
+#!/usr/bin/python
+
+# Copyright (c) 2017 [Guavus]
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+
+"""
+Benchmark the zabbix_config module against the fake Zabbix api.
+
+The module runs in-process, once per simulated Ansible task, against a
+FakeZabbix server. For each scenario and scale, reports:
+
+    * tasks: number of module invocations
+    * requests: api calls served, and calls per task
+    * wall: elapsed seconds
+    * peak: peak python memory allocated during the scenario (tracemalloc)
+    * sent, received: request and response bytes
+
+Scenarios:
+
+    * single: one task per item, first run creating them, second run
+      finding them unchanged
+    * bulk: one task with the list of all items, create then converge
+    * sync: one sync task with all items of the template
+    * batch: one batch task creating a group, templates with items and
+      triggers, and hosts linked to them, then converging
+    * import: configuration.import of a template holding all items, twice
+    * diff: object_diff of hosts with many templates, tags and macros, no
+      api call
+
+Usage:
+
+    python benchmark.py [--scales 10,1000,50000] [--latency 0.08]
+                        [--scenarios single,bulk,sync,batch,import,diff]
+                        [--fast-json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import ansible.module_utils
+from ansible.module_utils import basic
+from ansible.module_utils._text import to_bytes
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'library'))
+sys.path.insert(0, HERE)
+# module_utils of the role, found by ansible next to library
+ansible.module_utils.__path__.append(os.path.join(HERE, '..', 'module_utils'))
+
+import zabbix_config  # noqa: E402
+from ansible.module_utils.zabbix_api import object_diff  # noqa: E402
+from fake_zabbix import FakeZabbix  # noqa: E402
+
+SCENARIOS = ('single', 'bulk', 'sync', 'batch', 'import', 'diff')
+
+
+def run_module(args, module=zabbix_config):
+    """
+    Run a module main() in-process, as a single Ansible task would.
+
+    Returns: module result. Raises RuntimeError if the module failed.
+    """
+    basic._ANSIBLE_ARGS = to_bytes(json.dumps({'ANSIBLE_MODULE_ARGS': args}))
+    if hasattr(basic, '_ANSIBLE_PROFILE'):
+        basic._ANSIBLE_PROFILE = 'legacy'
+
+    stdout = sys.stdout
+    sys.stdout = out = StringIO()
+    try:
+        module.main()
+    except SystemExit:
+        pass
+    finally:
+        sys.stdout = stdout
+
+    result = json.loads(out.getvalue())
+    if result.get('failed'):
+        raise RuntimeError(result.get('msg'))
+    return result
+
+
+class Measure(object):
+    """
+    Measure api calls, wall time and peak memory of a block.
+    """
+
+    def __init__(self, fake, scenario, phase, scale):
+        self.fake = fake
+        self.row = dict(scenario=scenario, phase=phase, scale=scale, tasks=0)
+
+    def __enter__(self):
+        self.fake.reset_stats()
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None:
+            return False
+
+        self.row['wall'] = time.time() - self.start
+        self.row['requests'] = self.fake.requests
+        self.row['sent'] = self.fake.request_bytes
+        self.row['received'] = self.fake.response_bytes
+        self.row['peak'] = None
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            self.row['peak'] = tracemalloc.get_traced_memory()[1]
+        return False
+
+    def task(self, args):
+        self.row['tasks'] += 1
+        return run_module(args)
+
+
+def make_items(scale, prefix='item'):
+    return [dict(name="{} {}".format(prefix, i),
+                 key_="{}.key[{}]".format(prefix, i),
+                 type=2,
+                 value_type=3,
+                 delay=60)
+            for i in range(scale)]
+
+
+def bench_single(fake, base, scale):
+    rows = []
+    run_module(dict(base, api='template', api_args=dict(host='single')))
+    templateid = fake.get('template', dict(filter=dict(host='single')))[0][
+        'templateid']
+
+    items = make_items(scale)
+    for phase in ('create', 'converge'):
+        with Measure(fake, 'single', phase, scale) as m:
+            for item in items:
+                m.task(dict(base, api='item',
+                            api_args=dict(item, hostid=templateid)))
+        rows.append(m.row)
+    return rows
+
+
+def bench_bulk(fake, base, scale):
+    rows = []
+    run_module(dict(base, api='template', api_args=dict(host='bulk')))
+
+    items = make_items(scale)
+    for phase in ('create', 'converge'):
+        with Measure(fake, 'bulk', phase, scale) as m:
+            m.task(dict(base, api='item', template_name='bulk',
+                        api_args=items))
+        rows.append(m.row)
+    return rows
+
+
+def bench_sync(fake, base, scale):
+    rows = []
+    run_module(dict(base, api='template', api_args=dict(host='sync')))
+
+    items = make_items(scale)
+    for phase in ('create', 'converge'):
+        with Measure(fake, 'sync', phase, scale) as m:
+            m.task(dict(base, api='sync', template_name='sync', prune=True,
+                        api_args=dict(item=items)))
+        rows.append(m.row)
+    return rows
+
+
+def bench_batch(fake, base, scale):
+    rows = []
+    run_module(dict(base, api='hostgroup', api_args=dict(name='Templates')))
+
+    templates = ['batch {}'.format(i) for i in range(10)]
+    entries = [
+        dict(api='hostgroup', api_args=[dict(name='batch hosts')]),
+        dict(api='template',
+             api_args=[dict(host=t, groups=[dict(name='Templates')])
+                       for t in templates])]
+    for t in templates:
+        items = make_items(max(scale // 100, 1))
+        entries.append(dict(api='item', template_name=t, api_args=items))
+        entries.append(dict(
+            api='trigger', template_name=t,
+            api_args=[dict(description="{} {} high".format(
+                               t, item['name']),
+                           expression="{{{}:{}.last()}}>0".format(
+                               t, item['key_']))
+                      for item in items]))
+    entries.append(dict(
+        api='host',
+        api_args=[dict(host="batch host {}".format(i),
+                       groups=[dict(name='batch hosts')],
+                       templates=[dict(host=templates[i % len(templates)])],
+                       interfaces=[dict(type=1, main=1, useip=1,
+                                        ip='127.0.0.1', dns='',
+                                        port='10050')])
+                  for i in range(scale)]))
+
+    for phase in ('create', 'converge'):
+        with Measure(fake, 'batch', phase, scale) as m:
+            m.task(dict(base, api='batch', api_args=entries))
+        rows.append(m.row)
+    return rows
+
+
+def bench_import(fake, base, scale):
+    rows = []
+    name = 'import {}'.format(scale)
+    source = ''.join(
+        ['<?xml version="1.0" encoding="UTF-8"?>\n<zabbix_export>'
+         '<version>3.2</version><date>2017-01-01T00:00:00Z</date>'
+         '<templates><template><template>{}</template><items>'.format(name)] +
+        ['<item><name>{}</name><key>{}</key></item>'.format(
+            item['name'], item['key_']) for item in make_items(scale)] +
+        ['</items></template></templates></zabbix_export>'])
+
+    for phase, extra in (('import', {}),
+                         ('reimport', {}),
+                         ('digest', dict(import_digest='file')),
+                         ('digest-unchanged', dict(import_digest='file'))):
+        with Measure(fake, 'import', phase, scale) as m:
+            m.task(dict(base, api='configuration.import', template_name=name,
+                        api_args=dict(format='xml', source=source), **extra))
+        rows.append(m.row)
+    return rows
+
+
+def bench_diff(fake, base, scale):
+    hosts = []
+    for i in range(scale):
+        current = dict(
+            hostid=str(i),
+            host="host {}".format(i),
+            parentTemplates=[dict(templateid=str(t)) for t in range(100)],
+            tags=[dict(tag="tag{}".format(t), value=str(t))
+                  for t in range(20)],
+            macros=[dict(macro="{{$M{}}}".format(t), value=str(t))
+                    for t in range(20)])
+        desired = dict(
+            host="host {}".format(i),
+            templates=[dict(templateid=t) for t in reversed(range(100))],
+            tags=[dict(tag="tag{}".format(t), value=t)
+                  for t in reversed(range(20))],
+            macros=[dict(macro="{{$M{}}}".format(t), value=t)
+                    for t in range(20)])
+        hosts.append((current, desired))
+
+    with Measure(fake, 'diff', 'object_diff', scale) as m:
+        for current, desired in hosts:
+            if object_diff(current, desired):
+                raise RuntimeError("identical hosts reported as different")
+    return [m.row]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scales', default='10,1000,50000',
+                        help="comma separated number of objects")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds of latency injected per api call")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help="comma separated scenarios to run")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="do not trace memory, tracing slows down runs")
+    parser.add_argument('--fast-json', action='store_true',
+                        help="run the module with fast_json")
+    parser.add_argument('--json', action='store_true',
+                        help="print one json line per measure")
+    args = parser.parse_args()
+
+    if tracemalloc is not None and not args.no_memory:
+        tracemalloc.start()
+
+    if not args.json:
+        print("{:<8} {:<17} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9} {:>11}"
+              .format('scenario', 'phase', 'scale', 'tasks', 'requests',
+                      'req/task', 'wall s', 'peak MB', 'recv MB'))
+
+    for scenario in args.scenarios.split(','):
+        bench = globals()['bench_{}'.format(scenario)]
+        for scale in [int(s) for s in args.scales.split(',')]:
+            # a fresh server per measure, so that scales do not add up
+            fake = FakeZabbix(latency=args.latency)
+            fake.start()
+            cache_dir = tempfile.mkdtemp(prefix='zabbix-config-bench-')
+            base = dict(zabbix_url=fake.url,
+                        zabbix_user=fake.user,
+                        zabbix_password=fake.password,
+                        cache_dir=cache_dir,
+                        fast_json=args.fast_json)
+            try:
+                rows = bench(fake, base, scale)
+            finally:
+                fake.stop()
+                shutil.rmtree(cache_dir)
+
+            for row in rows:
+                if args.json:
+                    print(json.dumps(row))
+                    continue
+                print("{scenario:<8} {phase:<17} {scale:>7} {tasks:>7} "
+                      "{requests:>9} {per_task:>9.1f} {wall:>9.3f} "
+                      "{peak_mb:>9} {recv:>11.2f}".format(
+                          per_task=(float(row['requests']) / row['tasks']
+                                    if row['tasks'] else 0),
+                          peak_mb=('-' if row['peak'] is None else
+                                   "{:.1f}".format(row['peak'] / 1e6)),
+                          recv=row['received'] / 1e6,
+                          **row))
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,691 @@
+#!/usr/bin/python
+
+# Copyright (c) 2017 [Guavus]
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+
+"""
+In-process fake of the Zabbix JSON-RPC API.
+
+Serves the subset of the api used by the zabbix_config module on a local
+port, with an optional latency injected in every response:
+
+    * user.login, user.checkAuthentication, user.logout
+    * <object>.get, <object>.create, <object>.update, <object>.delete for the
+      objects of ZBX_API_UID, plus usermacro
+    * host.massadd, host.massremove, host.massupdate
+    * configuration.import, configuration.export
+
+Objects are kept in memory. Every call is counted per method, along with
+request and response sizes, so that benchmarks can report requests per task.
+
+Like a web server configured for it, gzip compressed requests and responses
+can be enabled. Transient failures of a load balancer are simulated by
+setting fail_requests to the number of next requests to answer with a 502.
+
+Usage:
+
+    zbx = FakeZabbix(latency=0.08)
+    zbx.start()
+    ... point zabbix_url to zbx.url ...
+    zbx.stop()
+"""
+
+import fnmatch
+import gzip
+import io
+import itertools
+import json
+import re
+import threading
+import time
+from collections import defaultdict
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+# Unique key of each object type, as in the module.
+UID = dict(
+    hostgroup='name',
+    template='host',
+    item='name',
+    trigger='description',
+    host='host',
+    user='alias',
+    graph='name',
+    discoveryrule='name',
+    usermacro='macro'
+)
+
+# Object types whose id field is not "<type>id".
+ID = dict(
+    hostgroup='groupid',
+    discoveryrule='itemid',
+    usermacro='hostmacroid'
+)
+
+# Function of a trigger expression, expanded as {<host>:<key>.<function>(...)}.
+FUNCTION = re.compile(r'{([^:{}$]+):(.+?)\.(\w+)\(([^)]*)\)}')
+
+# Object types whose unique key is only unique within their host.
+HOST_CHILDREN = ('item', 'trigger', 'graph', 'discoveryrule', 'usermacro')
+
+# select* option of get requests, mapped to the returned field and to the
+# object type of its elements.
+SELECTS = dict(
+    selectGroups=('groups', 'hostgroup'),
+    selectParentTemplates=('parentTemplates', 'template'),
+    selectHosts=('hosts', 'host'),
+    selectInterfaces=('interfaces', None),
+    selectTags=('tags', None),
+    selectMacros=('macros', None),
+    selectGraphItems=('gitems', None),
+    selectApplications=('applications', None),
+    selectFunctions=('functions', None),
+    selectItems=('items', 'item')
+)
+
+# Error data of the real api.
+NO_PERMISSIONS = "No permissions to referred object or it does not exist!"
+SESSION_TERMINATED = "Session terminated, re-login, please."
+PARSE_ERROR = ("Invalid JSON. An error occurred on the server while parsing "
+               "the JSON text.")
+
+
+class ApiError(Exception):
+
+    def __init__(self, data, message="Invalid params."):
+        Exception.__init__(self, data)
+        self.data = data
+        self.message = message
+
+
+def id_field(api):
+    return ID.get(api, "{}id".format(api))
+
+
+def as_list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+class FakeZabbix(object):
+    """
+    Fake Zabbix frontend.
+
+    latency: seconds slept before answering each request
+    user, password: credentials accepted by user.login
+    compression: decompress gzip requests and compress responses
+    """
+
+    def __init__(self, latency=0.0, user='Admin', password='zabbix',
+                 compression=False):
+        self.latency = latency
+        self.user = user
+        self.password = password
+        self.compression = compression
+        self.fail_requests = 0
+
+        self.lock = threading.Lock()
+        self.ids = itertools.count(10001)
+        self.objects = defaultdict(dict)
+        self.sessions = set()
+        self.imports = {}
+
+        self.server = None
+        self.url = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Reset call counters.
+        """
+        self.calls = defaultdict(int)
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    @property
+    def requests(self):
+        """
+        Total number of requests served since last reset_stats.
+        """
+        return sum(self.calls.values())
+
+    def start(self):
+        """
+        Serve the api on a random local port, in a background thread.
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            # buffer the response, sent in a single write once handled, to
+            # avoid delayed acks between headers and body
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+
+                with fake.lock:
+                    failed = fake.fail_requests > 0
+                    fake.fail_requests -= failed
+                if failed:
+                    self.send_response(502)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                compressed = fake.compression and 'gzip' in self.headers.get(
+                    'Accept-Encoding', '')
+                if fake.compression and self.headers.get(
+                        'Content-Encoding') == 'gzip':
+                    body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+
+                resp = fake.dispatch(body)
+                if compressed:
+                    out = io.BytesIO()
+                    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+                        f.write(resp)
+                    resp = out.getvalue()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if compressed:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(resp)))
+                self.end_headers()
+                self.wfile.write(resp)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/api_jsonrpc.php'.format(
+            self.server.server_address[1])
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def dispatch(self, body):
+        """
+        Answer a raw json-rpc request.
+
+        Returns: raw json-rpc response.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        try:
+            request = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return json.dumps(dict(
+                jsonrpc='2.0', id=None,
+                error=dict(code=-32700, message='Parse error.',
+                           data=PARSE_ERROR))).encode('utf-8')
+
+        try:
+            with self.lock:
+                self.calls[request['method']] += 1
+                self.request_bytes += len(body)
+                result = self.handle(request['method'],
+                                     request.get('params'),
+                                     request.get('auth'))
+            resp = dict(jsonrpc='2.0', result=result, id=request['id'])
+        except ApiError as e:
+            resp = dict(jsonrpc='2.0',
+                        error=dict(code=-32602, message=e.message,
+                                   data=e.data),
+                        id=request['id'])
+
+        resp = json.dumps(resp).encode('utf-8')
+        with self.lock:
+            self.response_bytes += len(resp)
+        return resp
+
+    def handle(self, method, params, auth):
+        """
+        Run an api method.
+
+        Returns: result of the method. Raises ApiError.
+        """
+        if method == 'user.login':
+            if (params.get('user') != self.user or
+                    params.get('password') != self.password):
+                raise ApiError("Login name or password is incorrect.")
+            token = "{:032x}".format(next(self.ids))
+            self.sessions.add(token)
+            return token
+
+        if method == 'user.checkAuthentication':
+            if params.get('sessionid') not in self.sessions:
+                raise ApiError(SESSION_TERMINATED)
+            return dict(alias=self.user, sessionid=params['sessionid'])
+
+        if auth not in self.sessions:
+            raise ApiError(SESSION_TERMINATED)
+
+        if method == 'user.logout':
+            self.sessions.discard(auth)
+            return True
+
+        if method == 'configuration.import':
+            return self.configuration_import(params)
+
+        if method == 'configuration.export':
+            return self.configuration_export(params)
+
+        api, _, action = method.rpartition('.')
+        if api not in UID:
+            raise ApiError('Incorrect API "{}".'.format(api))
+
+        if action == 'get':
+            return self.get(api, params)
+        if action == 'create':
+            return self.create(api, as_list(params))
+        if action == 'update':
+            return self.update(api, as_list(params))
+        if action == 'delete':
+            return self.delete(api, as_list(params))
+        if action in ('massadd', 'massremove', 'massupdate'):
+            return self.mass(api, action, params)
+
+        raise ApiError('Incorrect method "{}".'.format(method))
+
+    # read
+
+    def get(self, api, params):
+        id_string = id_field(api)
+        objects = self.objects[api].values()
+
+        for option in set(('hostids', 'templateids', 'groupids', 'itemids',
+                           'triggerids', 'graphids', id_string + 's')):
+            if option not in params:
+                continue
+            wanted = set(str(i) for i in as_list(params[option]))
+            objects = [o for o in objects
+                       if self.related_ids(api, o, option) & wanted]
+
+        for k, v in (params.get('filter') or {}).items():
+            wanted = set(str(x) for x in as_list(v))
+            if k == 'hostid' and api in ('trigger', 'graph'):
+                # filtered on the hosts of their items
+                objects = [o for o in objects
+                           if set(o.get('_hostids', [])) & wanted]
+                continue
+            objects = [o for o in objects if str(o.get(k)) in wanted]
+
+        for k, v in (params.get('search') or {}).items():
+            if not params.get('searchWildcardsEnabled'):
+                v = '*{}*'.format(v)
+            objects = [o for o in objects
+                       if fnmatch.fnmatchcase(str(o.get(k, '')), v)]
+
+        if params.get('sortfield'):
+            field = as_list(params['sortfield'])[0]
+            objects = sorted(objects, key=lambda o: sort_key(o.get(field)))
+            if params.get('sortorder') == 'DESC':
+                objects.reverse()
+
+        if params.get('limit'):
+            objects = list(objects)[:int(params['limit'])]
+
+        if params.get('countOutput'):
+            return str(len(list(objects)))
+
+        return [self.project(api, o, params) for o in objects]
+
+    def related_ids(self, api, obj, option):
+        """
+        Ids of obj matched by a get <type>ids option.
+        """
+        if option == "{}s".format(id_field(api)):
+            return set([obj[id_field(api)]])
+        if option == 'templateids' and api == 'template':
+            return set([obj['templateid']])
+        if option in ('hostids', 'templateids'):
+            return set(obj.get('_hostids', [obj.get('hostid')]))
+        if option == 'groupids':
+            return set(g['groupid'] for g in obj.get('groups', []))
+        if option == 'itemids':
+            return set(obj.get('_itemids', []))
+        return set()
+
+    def project(self, api, obj, params):
+        """
+        Apply output and select* params to an object.
+        """
+        output = params.get('output', 'extend')
+        out = {}
+        for k, v in obj.items():
+            if k.startswith('_') or isinstance(v, (list, dict)):
+                continue
+            if output == 'extend' or k in output:
+                out[k] = stringify(v)
+        out[id_field(api)] = obj[id_field(api)]
+
+        # functions referenced by id, unless expanded
+        if api == 'trigger' and not params.get('expandExpression'):
+            for k in ('expression', 'recovery_expression'):
+                if k in out and '_raw_' + k in obj:
+                    out[k] = obj['_raw_' + k]
+
+        for option, (field, element_api) in SELECTS.items():
+            if option not in params:
+                continue
+            elements = self.select(api, obj, field, element_api)
+            out[field] = [project_fields(e, params[option])
+                          for e in elements]
+
+        return out
+
+    def select(self, api, obj, field, element_api):
+        if field == 'parentTemplates':
+            return [self.objects['template'][t['templateid']]
+                    for t in obj.get('templates', [])
+                    if t['templateid'] in self.objects['template']]
+        if field == 'groups':
+            return [self.objects['hostgroup'][g['groupid']]
+                    for g in obj.get('groups', [])
+                    if g['groupid'] in self.objects['hostgroup']]
+        if field == 'hosts':
+            hostids = obj.get('_hostids', [obj.get('hostid')])
+            return [self.host_or_template(i) for i in hostids
+                    if self.host_or_template(i) is not None]
+        if field == 'items':
+            return [self.objects['item'][i] for i in obj.get('_itemids', [])
+                    if i in self.objects['item']]
+        if field == 'applications':
+            # passed as an array of ids, returned as objects
+            return [dict(applicationid=str(a))
+                    for a in obj.get('applications', [])]
+        return obj.get(field, [])
+
+    def host_or_template(self, hostid):
+        return (self.objects['host'].get(hostid) or
+                self.objects['template'].get(hostid))
+
+    # write
+
+    def create(self, api, params):
+        id_string = id_field(api)
+        created = []
+        for p in params:
+            obj = dict(p)
+            self.link(api, obj)
+            self.check_unique(api, obj)
+
+            obj[id_string] = str(next(self.ids))
+            if api == 'template':
+                obj['hostid'] = obj['templateid']
+            self.objects[api][obj[id_string]] = obj
+            created.append(obj[id_string])
+
+        return {"{}s".format(id_string): created}
+
+    def update(self, api, params):
+        id_string = id_field(api)
+        updated = []
+        for p in params:
+            obj = self.objects[api].get(str(p.get(id_string)))
+            if obj is None:
+                raise ApiError(NO_PERMISSIONS)
+
+            new = dict(obj)
+            new.update(p)
+            if 'templates_clear' in p:
+                cleared = set(t['templateid'] for t in p['templates_clear'])
+                new['templates'] = [t for t in new.get('templates', [])
+                                    if t['templateid'] not in cleared]
+                new.pop('templates_clear')
+            self.link(api, new)
+            self.check_unique(api, new)
+
+            self.objects[api][obj[id_string]] = new
+            updated.append(obj[id_string])
+
+        return {"{}s".format(id_string): updated}
+
+    def delete(self, api, ids):
+        id_string = id_field(api)
+        ids = [str(i) for i in ids]
+        if any(i not in self.objects[api] for i in ids):
+            raise ApiError(NO_PERMISSIONS)
+
+        for i in ids:
+            self.objects[api].pop(i)
+
+        return {"{}s".format(id_string): ids}
+
+    def mass(self, api, action, params):
+        """
+        host.massadd, massremove and massupdate of groups and templates.
+        """
+        id_string = id_field(api)
+        if action == 'massremove':
+            ids = [str(i) for i in as_list(params.get("{}s".format(
+                id_string)))]
+        else:
+            ids = [str(o[id_string]) for o in as_list(params.get(
+                "{}s".format(api)))]
+
+        for i in ids:
+            obj = self.objects[api].get(i)
+            if obj is None:
+                raise ApiError(NO_PERMISSIONS)
+
+            for field, key, remove_field in (
+                    ('groups', 'groupid', 'groupids'),
+                    ('templates', 'templateid', 'templateids')):
+                current = obj.get(field, [])
+                if action == 'massadd' and field in params:
+                    known = set(e[key] for e in current)
+                    current = current + [
+                        {key: str(e[key])} for e in params[field]
+                        if str(e[key]) not in known]
+                elif action == 'massremove' and remove_field in params:
+                    removed = set(str(r) for r in as_list(
+                        params[remove_field]))
+                    current = [e for e in current if e[key] not in removed]
+                elif action == 'massupdate' and field in params:
+                    current = [{key: str(e[key])} for e in params[field]]
+                obj[field] = current
+
+        return {"{}s".format(id_string): ids}
+
+    def link(self, api, obj):
+        """
+        Resolve the hosts and items an object belongs to.
+        """
+        for field, key in (('groups', 'groupid'), ('templates', 'templateid')):
+            if field in obj:
+                obj[field] = [{key: str(e[key])} for e in obj[field]]
+
+        if 'hostid' in obj and api != 'template':
+            obj['hostid'] = str(obj['hostid'])
+
+        if api == 'trigger' and 'expression' in obj:
+            names = re.findall(r'{([^:{}$]+):', obj['expression'])
+            hosts = [h for h in itertools.chain(
+                self.objects['host'].values(),
+                self.objects['template'].values()) if h['host'] in names]
+            obj['_hostids'] = [h['hostid'] for h in hosts]
+            obj['_itemids'] = [
+                i['itemid'] for i in self.objects['item'].values()
+                if i.get('hostid') in obj['_hostids'] and
+                '{}:{}.'.format(self.host_or_template(i['hostid'])['host'],
+                                i.get('key_')) in obj['expression']]
+
+            # as stored by zabbix: functions replaced by their id
+            obj['functions'] = []
+            for k in ('expression', 'recovery_expression'):
+                if k in obj:
+                    obj['_raw_' + k] = FUNCTION.sub(
+                        lambda m: self.function(obj, hosts, m),
+                        obj[k])
+
+        if api == 'graph' and 'gitems' in obj:
+            obj['gitems'] = [dict((k, stringify(v)) for k, v in g.items())
+                             for g in obj['gitems']]
+            obj['_itemids'] = [g['itemid'] for g in obj['gitems']]
+            obj['_hostids'] = list(set(
+                self.objects['item'][i]['hostid'] for i in obj['_itemids']
+                if i in self.objects['item']))
+
+    def function(self, trigger, hosts, match):
+        """
+        Register a function of a trigger expression.
+
+        Returns: the function reference of the raw expression.
+        """
+        host, key, function, parameter = match.groups()
+        itemids = [i['itemid'] for i in self.objects['item'].values()
+                   if i.get('key_') == key and
+                   any(h['hostid'] == i.get('hostid') and h['host'] == host
+                       for h in hosts)]
+        if not itemids:
+            raise ApiError('Incorrect item key "{}:{}" provided for trigger '
+                           'expression.'.format(host, key))
+
+        functionid = str(next(self.ids))
+        trigger['functions'].append(dict(functionid=functionid,
+                                         itemid=itemids[0],
+                                         function=function,
+                                         parameter=parameter))
+        return '{{{}}}'.format(functionid)
+
+    def check_unique(self, api, obj):
+        uid = UID[api]
+        id_string = id_field(api)
+        for other in self.objects[api].values():
+            if other[id_string] == obj.get(id_string):
+                continue
+            if other.get(uid) != obj.get(uid):
+                continue
+            if (api in HOST_CHILDREN and
+                    other.get('hostid') != obj.get('hostid')):
+                continue
+            raise ApiError('{} "{}" already exists.'.format(
+                api.capitalize(), obj.get(uid)))
+
+    # configuration
+
+    def configuration_import(self, params):
+        """
+        Create missing templates named in an import source.
+
+        Sources are recorded by template, to be returned by export.
+        """
+        source = params['source']
+        if params.get('format') == 'json':
+            doc = json.loads(source)['zabbix_export']
+            names = [t['template'] for t in doc.get('templates', [])]
+        else:
+            names = re.findall(
+                r'<template>\s*<template>([^<]+)</template>', source)
+
+        for name in names:
+            existing = [t for t in self.objects['template'].values()
+                        if t['host'] == name]
+            if not existing:
+                self.create('template', [dict(host=name, name=name)])
+            self.imports[name] = source
+
+        return True
+
+    def configuration_export(self, params):
+        """
+        Export templates or hosts with their items.
+        """
+        options = params.get('options', {})
+        fmt = params.get('format', 'xml')
+        date = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+        hosts = []
+        for kind in ('templates', 'hosts'):
+            api = kind[:-1]
+            for i in options.get(kind, []):
+                obj = self.objects[api].get(str(i))
+                if obj is None:
+                    raise ApiError(NO_PERMISSIONS)
+                items = sorted(
+                    (it for it in self.objects['item'].values()
+                     if it.get('hostid') == obj['hostid']),
+                    key=lambda it: it['name'])
+                hosts.append((api, obj, items))
+
+        if fmt == 'json':
+            return json.dumps(dict(zabbix_export=dict(
+                version='3.2', date=date,
+                templates=[dict(template=o['host'],
+                                items=[dict(name=it['name'],
+                                            key=it.get('key_', ''))
+                                       for it in items])
+                           for api, o, items in hosts])))
+
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<zabbix_export>'
+                 '<version>3.2</version><date>{}</date><templates>'
+                 .format(date)]
+        for api, obj, items in hosts:
+            parts.append('<template><template>{}</template><items>'
+                         .format(xml_escape(obj['host'])))
+            for it in items:
+                parts.append('<item><name>{}</name><key>{}</key></item>'
+                             .format(xml_escape(it['name']),
+                                     xml_escape(it.get('key_', ''))))
+            parts.append('</items></template>')
+        parts.append('</templates></zabbix_export>')
+        return ''.join(parts)
+
+
+def stringify(value):
+    """
+    Zabbix returns every scalar as a string.
+    """
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (list, dict)):
+        return value
+    return str(value)
+
+
+def project_fields(element, output):
+    """
+    Apply the output of a select* option to a list element.
+    """
+    if output == 'extend':
+        return dict((k, stringify(v)) for k, v in element.items()
+                    if not k.startswith('_'))
+    if output == 'count':
+        return element
+    return dict((k, stringify(element[k])) for k in as_list(output)
+                if k in element)
+
+
+def sort_key(value):
+    try:
+        return (0, int(value))
+    except (TypeError, ValueError):
+        return (1, str(value))
+
+
+def xml_escape(text):
+    return (str(text).replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;'))
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+
+# Copyright (c) 2017 [Guavus]
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+
+"""
+Tests of the zabbix_config and zabbix_facts modules, against the fake Zabbix
+api.
+
+Usage:
+
+    python -m pytest test_zabbix_config.py
+    python -m unittest test_zabbix_config
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'library'))
+sys.path.insert(0, HERE)
+
+from benchmark import run_module  # noqa: E402
+from fake_zabbix import FakeZabbix  # noqa: E402
+
+import zabbix_config  # noqa: E402
+import zabbix_facts  # noqa: E402
+from ansible.module_utils.zabbix_api import (Record,  # noqa: E402
+                                             Snapshot, object_diff, same_list)
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_scalars_compared_as_strings(self):
+        self.assertFalse(object_diff({'delay': '60', 'status': '0'},
+                                     {'delay': 60, 'status': 0}))
+
+        patch = object_diff({'delay': '60', 'status': '0'},
+                            {'delay': 30, 'name': 'a'})
+        self.assertEqual(patch.changes, {'delay': 30, 'name': 'a'})
+        self.assertEqual(patch.previous, {'delay': '60', 'name': None})
+
+    def test_field_alias(self):
+        current = {'parentTemplates': [{'templateid': '1', 'host': 'T'}]}
+        self.assertFalse(object_diff(current,
+                                     {'templates': [{'templateid': 1}]}))
+        self.assertTrue(object_diff(current,
+                                    {'templates': [{'templateid': 2}]}))
+
+    def test_interfaces_without_interfaceid(self):
+        current = [{'interfaceid': '7', 'type': '1', 'main': '1',
+                    'ip': '10.0.0.1', 'port': '10050'},
+                   {'interfaceid': '8', 'type': '2', 'main': '1',
+                    'ip': '10.0.0.1', 'port': '161'}]
+        desired = [{'type': 2, 'main': 1, 'ip': '10.0.0.1', 'port': '161'},
+                   {'type': 1, 'main': 1, 'ip': '10.0.0.1', 'port': 10050}]
+        self.assertTrue(same_list('interfaces', current, desired))
+
+        desired[1]['port'] = 10051
+        self.assertFalse(same_list('interfaces', current, desired))
+
+    def test_tags_keyed_by_tag_and_value(self):
+        current = [{'tag': 'env', 'value': 'prod'},
+                   {'tag': 'env', 'value': 'dc1'}]
+        self.assertTrue(same_list('tags', current,
+                                  [{'tag': 'env', 'value': 'dc1'},
+                                   {'tag': 'env', 'value': 'prod'}]))
+        self.assertFalse(same_list('tags', current,
+                                   [{'tag': 'env', 'value': 'prod'},
+                                    {'tag': 'env', 'value': 'dc2'}]))
+
+    def test_scalar_id_list(self):
+        current = [{'applicationid': '123'}, {'applicationid': '45'}]
+        self.assertTrue(same_list('applications', current, ['45', 123]))
+        self.assertFalse(same_list('applications', current, ['123']))
+        self.assertFalse(same_list('applications', current, ['123', '46']))
+        self.assertFalse(object_diff({'applications': current},
+                                     {'applications': [123, 45]}))
+
+    def test_reordering(self):
+        current = [{'groupid': '1'}, {'groupid': '2'}, {'groupid': '3'}]
+        self.assertTrue(same_list('groups', current,
+                                  [{'groupid': 3}, {'groupid': 1},
+                                   {'groupid': 2}]))
+        self.assertTrue(same_list('ports', ['1', '2'], [2, 1]))
+
+        # same elements in a nested list, reordered
+        current = [{'macro': '{$A}', 'value': 'x'},
+                   {'macro': '{$B}', 'value': 'y'}]
+        self.assertFalse(object_diff({'macros': current},
+                                     {'macros': list(reversed(current))}))
+
+    def test_list_length(self):
+        current = [{'groupid': '1'}, {'groupid': '2'}]
+        self.assertFalse(same_list('groups', current, [{'groupid': 1}]))
+        self.assertFalse(same_list('groups', current,
+                                   [{'groupid': 1}, {'groupid': 1},
+                                    {'groupid': 2}]))
+
+
+class ModuleTestCase(unittest.TestCase):
+    """
+    Runs the module against a FakeZabbix server started for each test.
+    """
+
+    def setUp(self):
+        self.fake = FakeZabbix()
+        self.fake.start()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def run_module(self, module=zabbix_config, **args):
+        return run_module(dict(dict(zabbix_url=self.fake.url,
+                                    zabbix_user=self.fake.user,
+                                    zabbix_password=self.fake.password,
+                                    cache_dir=self.cache_dir),
+                               **args), module)
+
+
+class BatchTest(ModuleTestCase):
+
+    def batch(self, entries):
+        return self.run_module(api='batch', api_args=entries)
+
+    def entries(self, template_state, item_state):
+        return [{'api': 'hostgroup', 'api_args': [{'name': 'Templates'}]},
+                {'api': 'template', 'state': template_state,
+                 'api_args': [{'host': 'T',
+                               'groups': [{'name': 'Templates'}]}]},
+                {'api': 'item', 'template_name': 'T', 'state': item_state,
+                 'api_args': [{'name': 'a', 'key_': 'a', 'type': 2,
+                               'value_type': 3, 'delay': 60}]}]
+
+    def test_absent_entry_of_template_provided_by_batch(self):
+        # template created by the batch, nothing to delete from it yet
+        result = self.batch(self.entries('present', 'absent'))
+        self.assertTrue(result['changed'])
+        self.assertEqual([o['action'] for o in result['meta'][2]['objects']],
+                         [None])
+        self.assertEqual(len(self.fake.get('template', {})), 1)
+
+    def test_absent_entry_of_existing_template_provided_by_batch(self):
+        self.batch(self.entries('present', 'present'))
+        self.assertEqual(len(self.fake.get('item', {})), 1)
+
+        result = self.batch(self.entries('present', 'absent'))
+        self.assertEqual([o['action'] for o in result['meta'][2]['objects']],
+                         ['delete'])
+        self.assertEqual(self.fake.get('item', {}), [])
+
+    def test_absent_entries_of_absent_template(self):
+        self.batch(self.entries('present', 'present'))
+
+        result = self.batch(self.entries('absent', 'absent'))
+        self.assertEqual([o['action'] for o in result['meta'][1]['objects']],
+                         ['delete'])
+        self.assertEqual(self.fake.get('template', {}), [])
+
+
+class ItemTest(ModuleTestCase):
+
+    def test_applications_converge(self):
+        self.run_module(api='hostgroup', api_args={'name': 'Templates'})
+        groupid = self.fake.get('hostgroup', {})[0]['groupid']
+        self.run_module(api='template', api_args={
+            'host': 'T', 'groups': [{'groupid': groupid}]})
+        items = [{'name': 'a', 'key_': 'a', 'type': 2, 'value_type': 3,
+                  'delay': 60, 'applications': ['123', '45']}]
+
+        result = self.run_module(api='item', template_name='T',
+                                 api_args=items)
+        self.assertTrue(result['changed'])
+
+        items[0]['applications'] = ['45', '123']
+        result = self.run_module(api='item', template_name='T',
+                                 api_args=items)
+        self.assertFalse(result['changed'])
+
+
+class SnapshotTest(ModuleTestCase):
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.snapshot = os.path.join(self.cache_dir, 'snapshot.json.gz')
+
+        self.run_module(api='hostgroup', api_args={'name': 'Templates'})
+        groupid = self.fake.get('hostgroup', {})[0]['groupid']
+        self.run_module(api='template', api_args={
+            'host': 'T', 'groups': [{'groupid': groupid}]})
+        self.items = [{'name': 'item {}'.format(i), 'key_': 'key{}'.format(i),
+                       'type': 2, 'value_type': 3, 'delay': 60}
+                      for i in range(5)]
+        self.run_module(api='item', template_name='T', api_args=self.items)
+        self.run_module(api='snapshot', snapshot=self.snapshot,
+                        api_args=['hostgroup', 'template', 'item'])
+
+    def test_get_returns_projected_records(self):
+        snapshot = Snapshot(self.snapshot)
+        items = snapshot.get('item', {'output': ['itemid', 'name'],
+                                      'filter': {'name': ['item 1']}})
+        self.assertEqual(len(items), 1)
+        self.assertIsInstance(items[0], Record)
+        self.assertEqual(sorted(items[0].keys()), ['itemid', 'name'])
+        self.assertEqual(items[0]['name'], 'item 1')
+
+    def test_converge_from_snapshot(self):
+        self.fake.reset_stats()
+        result = self.run_module(api='item', template_name='T',
+                                 api_args=self.items, snapshot=self.snapshot)
+        self.assertFalse(result['changed'])
+        self.assertEqual(self.fake.requests, 0)
+
+    def test_facts_from_snapshot(self):
+        result = self.run_module(zabbix_facts, snapshot=self.snapshot,
+                                 queries=['template'])
+        facts = result['ansible_facts']['zabbix_facts']['template']
+        templateid = facts['ids']['T']
+        self.assertEqual(facts['objects'][templateid]['host'], 'T')
+
+
+class FactsTest(ModuleTestCase):
+
+    def test_cached_facts_without_login(self):
+        self.run_module(api='hostgroup', api_args={'name': 'Templates'})
+        result = self.run_module(zabbix_facts, queries=['hostgroup'])
+        self.assertIn('Templates',
+                      result['ansible_facts']['zabbix_facts']['hostgroup']
+                      ['ids'])
+
+        self.fake.reset_stats()
+        cached = self.run_module(zabbix_facts, queries=['hostgroup'])
+        self.assertEqual(cached['ansible_facts'], result['ansible_facts'])
+        self.assertEqual(self.fake.requests, 0)
+
+
+class ExportTest(ModuleTestCase):
+
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.dest = os.path.join(self.cache_dir, 'exports')
+
+        self.run_module(api='hostgroup', api_args={'name': 'Templates'})
+        groupid = self.fake.get('hostgroup', {})[0]['groupid']
+        for name in ('T1', 'T2'):
+            self.run_module(api='template', api_args={
+                'host': name, 'groups': [{'groupid': groupid}]})
+
+    def export(self, **args):
+        return self.run_module(api='configuration.export', kind='template',
+                               export_pattern='T*', export_dest=self.dest,
+                               api_args={'format': 'xml'}, **args)
+
+    def test_export_unchanged(self):
+        result = self.export()
+        self.assertTrue(result['changed'])
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         ['T1.xml', 'T2.xml'])
+
+        result = self.export(export_compress=False)
+        self.assertFalse(result['changed'])
+
+    def test_export_after_session_terminated(self):
+        self.export()
+
+        # sessions terminated once the templates are read
+        handle = self.fake.handle
+
+        def terminate(method, params, auth):
+            if method == 'configuration.export':
+                self.fake.sessions.clear()
+                self.fake.handle = handle
+            return handle(method, params, auth)
+
+        self.fake.handle = terminate
+        self.fake.reset_stats()
+        result = self.export(workers=1)
+        self.assertFalse(result['changed'])
+        # both exports are sent again with the new token, one login
+        self.assertEqual(self.fake.calls['user.login'], 2)
+        self.assertEqual(self.fake.calls['configuration.export'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()